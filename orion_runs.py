@@ -1,19 +1,174 @@
 #!/usr/bin/env python
 import argparse
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+import copy
+import multiprocessing
 import os
 
 import gin
-from orion.client import report_results
 import torch
 
+from src.pruning import TrialPruner
 from train import train
 
+
+def _init_worker(config_str, num_threads):
+    # workers are spawned so they get the parent's gin bindings explicitly
+    torch.set_num_threads(num_threads)
+    gin.parse_config(config_str)
+
+
+def _train_seed(savedir, random_seed, pruner=None):
+    if pruner is not None:
+        pruner.start_run(random_seed)
+    error = train(savedir=savedir,
+                  random_seed=random_seed,
+                  epoch_callback=pruner)
+    return error, pruner.reason if pruner is not None else None
+
+
+def _aggregate(errors, aggregate_seeds):
+    if aggregate_seeds == 'mean':
+        return sum(errors) / len(errors)
+    elif aggregate_seeds == 'min':
+        return min(errors)
+
+
+def add_trial_args(parser):
+    # how a trial trains its seeds, shared with trial_runner.py
+    parser.add_argument('--aggregate_seeds', choices=['mean', 'min'], default='mean')
+    parser.add_argument('--batch_seeds', action='store_true',
+                        help='train all seeds together as one batched ensemble')
+    parser.add_argument('--sweep_biases', type=int, nargs='+',
+                        help='train every Game.bias in one batched run, savedir must contain a {bias} field, '
+                             'the objective is the mean over biases of each bias\'s aggregate over seeds')
+    parser.add_argument('--num_workers', type=int, default=1,
+                        help='run the seeds in parallel processes, not with --batch_seeds or --sweep_biases')
+    parser.add_argument('--threads_per_worker', type=int, default=1,
+                        help='torch intra-op threads for each parallel worker')
+    parser.add_argument('--thread_workers', action='store_true',
+                        help='run the parallel seeds as threads of this process instead of processes')
+    parser.add_argument('--prune', action='store_true',
+                        help='stop trials that fall behind at successive halving rungs, '
+                             'rungs are shared through the parent directory of savedir')
+    parser.add_argument('--min_epochs', type=int, default=5,
+                        help='first successive halving rung')
+    parser.add_argument('--reduction_factor', type=int, default=2,
+                        help='only the best 1/reduction_factor of runs continue past each rung')
+    parser.add_argument('--divergence_threshold', type=float, default=None,
+                        help='stop runs whose sender and recver test L1 errors are both above this')
+    parser.add_argument('--divergence_start', type=int, default=10,
+                        help='first epoch checked for divergence')
+
+
+def run_trial(args, savedir):
+    # train all seeds of one trial with the parsed gin config and return its objective
+    if args.num_workers > 1 and (args.batch_seeds or args.sweep_biases):
+        raise ValueError('--num_workers runs separate seeds in parallel, it can\'t be used with '
+                         '--batch_seeds or --sweep_biases which train all seeds as one batched run')
+    # a bias sweep is one trial, its rungs and id come from the dir of the first bias
+    trial_dir = savedir.format(bias=args.sweep_biases[0]) if savedir and args.sweep_biases else savedir
+
+    pruner = None
+    if args.prune or args.divergence_threshold is not None:
+        rung_file = None
+        if args.prune:
+            if not savedir:
+                raise ValueError('--prune needs a --savedir to share rungs between trials')
+            # orion puts every trial's working dir in the experiment's working dir
+            rung_file = os.path.join(os.path.dirname(os.path.abspath(trial_dir)), 'pruning_rungs.json')
+        pruner = TrialPruner(trial_id=os.path.basename(os.path.abspath(trial_dir or 'trial')),
+                             rung_file=rung_file,
+                             num_epochs=gin.query_parameter('train.num_epochs'),
+                             min_epochs=args.min_epochs,
+                             reduction_factor=args.reduction_factor,
+                             divergence_threshold=args.divergence_threshold,
+                             divergence_start=args.divergence_start)
+
+    seeds = list(range(5))
+    pruned = None
+    if args.sweep_biases:
+        errors = train(savedir=savedir,
+                       ensemble_seeds=seeds,
+                       sweep_biases=args.sweep_biases,
+                       epoch_callback=pruner)
+        pruned = pruner.reason if pruner is not None else None
+    elif args.batch_seeds:
+        errors = train(savedir=savedir,
+                       ensemble_seeds=seeds,
+                       epoch_callback=pruner)
+        pruned = pruner.reason if pruner is not None else None
+    else:
+        seed_savedirs = []
+        for random_seed in seeds:
+            if savedir:
+                os.makedirs(savedir, exist_ok=True)
+
+                seed_savedirs.append(f'{savedir}/{random_seed}')
+            else:
+                seed_savedirs.append(None)
+
+        if args.num_workers > 1:
+            if args.thread_workers:
+                # every run draws from its own generators, so threads give the same results
+                executor = ThreadPoolExecutor(max_workers=args.num_workers)
+            else:
+                executor = ProcessPoolExecutor(max_workers=args.num_workers,
+                                               mp_context=multiprocessing.get_context('spawn'),
+                                               initializer=_init_worker,
+                                               initargs=(gin.config_str(), args.threads_per_worker))
+            with executor:
+                # map keeps the seed order so aggregation matches the serial loop
+                # every worker gets a copy of the pruner so seeds are pruned independently
+                results = list(executor.map(_train_seed, seed_savedirs, seeds,
+                                            [copy.deepcopy(pruner) for _ in seeds]))
+            errors = [error for error, _ in results]
+            pruned = next((reason for _, reason in results if reason is not None), None)
+        else:
+            errors = []
+            for seed_savedir, random_seed in zip(seed_savedirs, seeds):
+                best_error, pruned = _train_seed(seed_savedir, random_seed, pruner)
+                errors.append(best_error)
+                # the trial is already worse than the others, skip the remaining seeds
+                if pruned:
+                    break
+
+    # gen_results skips trial directories with a `pruned` file, a pruned sweep marks every bias
+    if pruned is not None:
+        print(f'trial pruned: {pruned}')
+        if savedir:
+            trial_dirs = [savedir.format(bias=bias) for bias in args.sweep_biases] if args.sweep_biases else [savedir]
+            for pruned_dir in trial_dirs:
+                with open(f'{pruned_dir}/pruned', 'w') as f:
+                    f.write(f'{pruned}\n')
+
+        # the seeds a pruned trial trained depend on --num_workers, so instead of their errors
+        # orion gets the largest L1 error on the circle (num_points / 2 for each player)
+        objective = gin.query_parameter('Game.num_points')
+        print(f'pruned trial objective: {objective:2.2f}')
+    elif args.sweep_biases:
+        # one objective for the whole sweep: every bias aggregates its own seeds
+        # and orion gets the mean over the biases
+        bias_errors = [errors[index * len(seeds):(index + 1) * len(seeds)]
+                       for index in range(len(args.sweep_biases))]
+        bias_objectives = [_aggregate(bias_seed_errors, args.aggregate_seeds) for bias_seed_errors in bias_errors]
+        for bias, bias_objective in zip(args.sweep_biases, bias_objectives):
+            print(f'bias {bias} {args.aggregate_seeds} error over seeds: {bias_objective:2.2f}')
+        objective = sum(bias_objectives) / len(bias_objectives)
+        print(f'mean over biases of the {args.aggregate_seeds} error over seeds: {objective:2.2f}')
+    else:
+        objective = _aggregate(errors, args.aggregate_seeds)
+        print(f'{args.aggregate_seeds} error over seeds: {objective:2.2f}')
+
+    return objective
+
+
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
     parser.add_argument('--config', '--gin_file', nargs='+')
     parser.add_argument('--gin_param', '-p', nargs='+')
     parser.add_argument('--savedir')
-    parser.add_argument('--aggregate_seeds', choices=['mean', 'min'], default='mean')
+    add_trial_args(parser)
     args = parser.parse_args()
 
     # change device to torch.device
@@ -23,26 +178,10 @@ if __name__ == '__main__':
     gin.parse_config_files_and_bindings(args.config, args.gin_param)
     print(gin.operative_config_str())
 
-    errors = []
-    for random_seed in range(5):
-        if args.savedir:
-            os.makedirs(args.savedir, exist_ok=True)
-
-            seed_savedir = f'{args.savedir}/{random_seed}'
-        else:
-            seed_savedir = None
-
-        best_error = train(savedir=seed_savedir,
-                           random_seed=random_seed)
-        errors.append(best_error)
-
-    if args.aggregate_seeds == 'mean':
-        objective = sum(errors) / len(errors)
-    elif args.aggregate_seeds == 'min':
-        objective = min(errors)
-
-    print(f'{args.aggregate_seeds} error over seeds: {objective:2.2f}')
+    objective = run_trial(args, args.savedir)
 
+    # imported here so trial_runner.py can run trials without orion
+    from orion.client import report_results
     report_results([dict(
         name=f'{args.aggregate_seeds}_error_over_seeds',
         type='objective',
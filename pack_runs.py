@@ -0,0 +1,158 @@
+#!/usr/bin/env python
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+import contextlib
+import io
+import json
+import multiprocessing
+import os
+from pathlib import Path
+import time
+
+import gin
+import torch
+
+from train import train
+
+
+# configs that only differ in other bindings (like Game.bias) train at the same speed
+# and share a calibration
+CALIBRATION_BINDINGS = ('train.Sender', 'train.Recver', 'train.vocab_size', 'train.batch_size')
+
+
+def _init_worker(core_sets, num_threads):
+    # every worker takes its own set of cores
+    cores = core_sets.get()
+    if hasattr(os, 'sched_setaffinity'):
+        os.sched_setaffinity(0, cores)
+    torch.set_num_threads(num_threads)
+
+
+def _parse(config, gin_params):
+    gin.clear_config()
+    gin.parse_config_files_and_bindings([config], gin_params)
+
+
+def _calibration_key(config, gin_params):
+    _parse(config, gin_params)
+    key = []
+    for name in CALIBRATION_BINDINGS:
+        try:
+            key.append(str(gin.query_parameter(name)))
+        except ValueError:
+            key.append(None)
+    return tuple(key)
+
+
+def _run_job(config, gin_params, savedir, seed):
+    _parse(config, gin_params)
+    start = time.perf_counter()
+    with contextlib.redirect_stdout(io.StringIO()):
+        error = train(savedir=savedir, random_seed=seed)
+    print(f'{savedir}: {error:2.2f} in {time.perf_counter() - start:.1f}s', flush=True)
+    return error
+
+
+def _calibration_job(config, gin_params, num_batches):
+    # batches per second of a short run, without saving anything
+    _parse(config, gin_params + ['train.num_epochs = 1', f'train.num_batches = {num_batches}'])
+    with contextlib.redirect_stdout(io.StringIO()):
+        # the first run in a fresh worker pays for lazy initialization
+        train(random_seed=0)
+        start = time.perf_counter()
+        train(random_seed=0)
+    return num_batches / (time.perf_counter() - start)
+
+
+def _executor(cores, num_threads):
+    # one worker per `num_threads` cores, OMP_NUM_THREADS is inherited by the spawned workers
+    os.environ['OMP_NUM_THREADS'] = str(num_threads)
+    num_workers = max(1, len(cores) // num_threads)
+    context = multiprocessing.get_context('spawn')
+    core_sets = context.Queue()
+    for worker in range(num_workers):
+        core_sets.put(set(cores[worker * num_threads:(worker + 1) * num_threads]))
+    return num_workers, ProcessPoolExecutor(max_workers=num_workers,
+                                            mp_context=context,
+                                            initializer=_init_worker,
+                                            initargs=(core_sets, num_threads))
+
+
+def calibrate(config, gin_params, cores, num_batches):
+    # aggregate batches/sec over all workers for every threads-per-run that divides the cores
+    candidates = [threads for threads in range(1, len(cores) + 1) if len(cores) % threads == 0]
+    throughputs = {}
+    for num_threads in candidates:
+        num_workers, executor = _executor(cores, num_threads)
+        with executor:
+            rates = list(executor.map(_calibration_job, [config] * num_workers,
+                                      [gin_params] * num_workers, [num_batches] * num_workers))
+        throughputs[num_threads] = sum(rates)
+        print(f'{num_threads} threads x {num_workers} runs: {throughputs[num_threads]:.1f} batches/s')
+    return max(throughputs, key=throughputs.get), throughputs
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='run every seed of every config packed on the cores of this node')
+    parser.add_argument('--configs', nargs='+', required=True)
+    parser.add_argument('--gin_param', '-p', nargs='+', default=[])
+    parser.add_argument('--seeds', type=int, nargs='+', default=list(range(5)))
+    parser.add_argument('--savedir', required=True,
+                        help='runs are saved in {savedir}/{seed}, savedir can contain a {config} field '
+                             'for the config file name without .gin')
+    parser.add_argument('--cores', type=int, default=None, help='number of cores to use, default all available')
+    parser.add_argument('--threads_per_run', type=int, default=None,
+                        help='skip the calibration and use this many threads per run')
+    parser.add_argument('--calibration_batches', type=int, default=50)
+    args = parser.parse_args()
+
+    if hasattr(os, 'sched_getaffinity'):
+        cores = sorted(os.sched_getaffinity(0))
+    else:
+        cores = list(range(os.cpu_count()))
+    if args.cores is not None:
+        cores = cores[:args.cores]
+
+    if len(args.configs) > 1 and '{config}' not in args.savedir:
+        raise ValueError('savedir needs a {config} field to save several configs')
+
+    groups = {}
+    for config in args.configs:
+        groups.setdefault(_calibration_key(config, args.gin_param), []).append(config)
+
+    # every group of configs is calibrated and then packed on its own
+    for configs in groups.values():
+        if args.threads_per_run is None:
+            print(f'calibrating {", ".join(configs)}')
+            num_threads, throughputs = calibrate(configs[0], args.gin_param, cores, args.calibration_batches)
+        else:
+            num_threads, throughputs = args.threads_per_run, {}
+
+        jobs = []
+        for config in configs:
+            savedir = args.savedir.format(config=Path(config).stem)
+            for seed in args.seeds:
+                jobs.append((config, args.gin_param, f'{savedir}/{seed}', seed))
+
+        num_workers, executor = _executor(cores, num_threads)
+        print(f'running {len(jobs)} runs on {len(cores)} cores: '
+              f'{num_workers} at a time with {num_threads} threads each')
+        start = time.perf_counter()
+        with executor:
+            errors = list(executor.map(_run_job, *zip(*jobs)))
+        seconds = time.perf_counter() - start
+        print(f'finished {len(jobs)} runs in {seconds:.1f}s')
+
+        # packing.json next to the seeds of every config
+        for config in configs:
+            packing = {'cores': cores,
+                       'threads_per_run': num_threads,
+                       'runs_at_a_time': num_workers,
+                       'calibration_config': configs[0],
+                       'calibration_batches_per_s': throughputs,
+                       'seconds': seconds,
+                       'runs': [{'config': job_config, 'savedir': savedir, 'seed': seed, 'error': error}
+                                for (job_config, _, savedir, seed), error in zip(jobs, errors)
+                                if job_config == config]}
+            with open(os.path.join(args.savedir.format(config=Path(config).stem), 'packing.json'), 'w') as f:
+                json.dump(packing, f, indent=2)
@@ -0,0 +1,241 @@
+import argparse
+import contextlib
+import io
+import json
+from pathlib import Path
+import platform
+import re
+import statistics
+import time
+
+import gin
+import torch
+
+from src.agents import mode, Deterministic, Reinforce, Gaussian
+from src.compiled import step_losses, make_optimizer
+from src.evaluate import make_evaluator
+from src.game import Game, CircleL1, CircleL2
+from train import train, test_agents
+
+
+def timeit(fn, repeats, warmup=1):
+    for _ in range(warmup):
+        fn()
+
+    times = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - start)
+
+    return {'median': statistics.median(times),
+            'min': min(times),
+            'repeats': repeats}
+
+
+def bench_game(repeats):
+    results = {}
+    for pregenerate in (False, True):
+        game = Game(num_points=36, bias=3, batch_size=64, num_batches=250, pregenerate=pregenerate)
+
+        def epoch():
+            for _ in game:
+                pass
+
+        result = timeit(epoch, repeats)
+        result['batches_per_s'] = game.num_batches / result['median']
+        results[f'game/iter/pregenerate={pregenerate}'] = result
+
+    return results
+
+
+def bench_losses(repeats, sizes=((64, 1), (100, 256), (100, 4096), (256, 16384))):
+    results = {}
+    for Loss in (CircleL1, CircleL2):
+        loss_fn = Loss(36)
+        for batch, vocab in sizes:
+            output = (100 * torch.randn(batch, vocab)).requires_grad_()
+            target = 36 * torch.rand(batch, 1)
+
+            def forward_backward():
+                output.grad = None
+                loss_fn(output, target).mean().backward()
+
+            result = timeit(forward_backward, repeats)
+            result['elements_per_s'] = batch * vocab / result['median']
+            results[f'loss/{Loss.__name__}/{batch}x{vocab}'] = result
+
+    return results
+
+
+def bench_policies(repeats, batch_size=64, hidden_size=32, vocab_size=256):
+    policies = {
+        'Reinforce': (Reinforce(input_size=1, output_size=vocab_size, hidden_size=hidden_size,
+                                lr=1e-3, ent_reg=1e-2, mode=mode.SENDER),
+                      36 * torch.rand(batch_size, 1)),
+        'Gaussian': (Gaussian(input_size=1, output_size=1, hidden_size=hidden_size,
+                              lr=1e-3, ent_reg=1e-2, mode=mode.SENDER),
+                     36 * torch.rand(batch_size, 1)),
+        'Deterministic': (Deterministic(input_size=vocab_size, output_size=1, hidden_size=hidden_size,
+                                        lr=1e-3, mode=mode.RECVER),
+                          torch.randint(vocab_size, (batch_size,))),
+    }
+
+    results = {}
+    for name, (policy, state) in policies.items():
+        policy.train()
+
+        def forward():
+            with torch.no_grad():
+                policy(state)
+
+        def forward_loss():
+            output, logprobs, entropy = policy(state)
+            error = CircleL1(36)(output.float(), 36 * torch.rand(batch_size, 1)).squeeze(-1)
+            loss, _ = policy.loss(error, logprobs, entropy)
+            policy.zero_grad()
+            loss.backward()
+
+        results[f'policy/{name}/forward'] = timeit(forward, repeats)
+        results[f'policy/{name}/forward_loss'] = timeit(forward_loss, repeats)
+
+    return results
+
+
+def bench_vocab(repeats, vocab_sizes=(256, 4096, 32768, 131072), batch_size=64, hidden_size=32):
+    # a full training step of Reinforce -> Deterministic as the vocabulary grows, by default,
+    # with the sparse receiver embedding and also with cdf sampling of the messages
+    modes = {'default': (False, False), 'sparse': (True, False), 'sparse+cdf': (True, True)}
+    results = {}
+    loss_fn = CircleL1(36)
+    for vocab_size in vocab_sizes:
+        for name, (sparse, cdf_sampling) in modes.items():
+            sender = Reinforce(input_size=1, output_size=vocab_size, hidden_size=hidden_size,
+                               lr=1e-3, ent_reg=1e-2, cdf_sampling=cdf_sampling, mode=mode.SENDER)
+            recver = Deterministic(input_size=vocab_size, output_size=1, hidden_size=hidden_size,
+                                   lr=1e-3, sparse=sparse, mode=mode.RECVER)
+            send_opt = make_optimizer(sender)
+            recv_opt = make_optimizer(recver)
+            game = Game(num_points=36, bias=3, batch_size=batch_size, num_batches=1)
+
+            def step():
+                for send_target, recv_target in game:
+                    send_loss, recv_loss, _, _ = step_losses(sender, recver, loss_fn, send_target, recv_target)
+                    for loss, optimizer in ((send_loss, send_opt), (recv_loss, recv_opt)):
+                        optimizer.zero_grad()
+                        loss.backward()
+                        optimizer.step()
+
+            result = timeit(step, repeats)
+            result['vocab_size'] = vocab_size
+            results[f'vocab/{vocab_size}/{name}/train_step'] = result
+
+    return results
+
+
+def bench_configs(repeats, config_dir='configs'):
+    results = {}
+    # search spaces have orion priors that gin can't parse
+    configs = sorted(path for path in Path(config_dir).glob('*.gin')
+                     if path.name != 'base.gin' and not path.name.endswith('-search.gin'))
+    for config in configs:
+        gin.clear_config()
+        gin.parse_config_files_and_bindings([str(config)], ['train.num_epochs=1',
+                                                            'train.random_seed=0'])
+
+        def epoch():
+            with contextlib.redirect_stdout(io.StringIO()):
+                train()
+
+        results[f'config/{config.stem}/train_epoch'] = timeit(epoch, repeats)
+
+        Sender = gin.query_parameter('train.Sender').configurable.wrapper
+        Recver = gin.query_parameter('train.Recver').configurable.wrapper
+        vocab_size = gin.query_parameter('train.vocab_size')
+        sender = Sender(input_size=1, output_size=vocab_size, mode=mode.SENDER)
+        recver = Recver(input_size=vocab_size, output_size=1, mode=mode.RECVER)
+        test_game = Game(num_batches=1, batch_size=100, training=False)
+        evaluator = make_evaluator(sender, test_game.num_points, CircleL1(test_game.num_points))
+
+        results[f'config/{config.stem}/test_phase'] = timeit(
+            lambda: test_agents(sender, recver, test_game, evaluator, vocab_size, torch.device('cpu')),
+            repeats)
+
+    gin.clear_config()
+    return results
+
+
+SUITES = {
+    'game': bench_game,
+    'losses': bench_losses,
+    'policies': bench_policies,
+    'vocab': bench_vocab,
+    'configs': bench_configs,
+}
+
+
+def compare(results, baseline, tolerance):
+    # ratio of median times, > 1 is slower than the baseline
+    regressions = []
+    for name, result in sorted(results.items()):
+        if name not in baseline:
+            continue
+        ratio = result['median'] / baseline[name]['median']
+        flag = ''
+        if ratio > 1 + tolerance:
+            flag = 'REGRESSION'
+            regressions.append(name)
+        elif ratio < 1 - tolerance:
+            flag = 'faster'
+        print(f'{name:60} {baseline[name]["median"] * 1e3:10.3f}ms {result["median"] * 1e3:10.3f}ms {ratio:6.2f}x {flag}')
+
+    return regressions
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='benchmark the game, losses, policies and full epochs')
+    parser.add_argument('--suites', nargs='+', choices=list(SUITES), default=list(SUITES))
+    parser.add_argument('--filter', default=None, help='only keep benchmarks whose name matches this regex')
+    parser.add_argument('--repeats', type=int, default=10)
+    parser.add_argument('--threads', type=int, default=None, help='torch.set_num_threads')
+    parser.add_argument('--output', '-o', default=None, help='write results as json')
+    parser.add_argument('--baseline', default=None, help='json results to compare against')
+    parser.add_argument('--tolerance', type=float, default=0.1,
+                        help='relative slowdown over the baseline counted as a regression')
+    args = parser.parse_args()
+
+    if args.threads is not None:
+        torch.set_num_threads(args.threads)
+
+    results = {}
+    for suite in args.suites:
+        # the configs are slow so run them fewer times
+        repeats = max(1, args.repeats // 5) if suite == 'configs' else args.repeats
+        results.update(SUITES[suite](repeats))
+
+    if args.filter:
+        results = {name: result for name, result in results.items() if re.search(args.filter, name)}
+
+    for name, result in sorted(results.items()):
+        print(f'{name:60} {result["median"] * 1e3:10.3f}ms')
+
+    output = {
+        'meta': {
+            'torch': torch.__version__,
+            'python': platform.python_version(),
+            'machine': platform.machine(),
+            'threads': torch.get_num_threads(),
+        },
+        'results': results,
+    }
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(output, f, indent=2)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)['results']
+        print(f'\ncompared to {args.baseline}')
+        regressions = compare(results, baseline, args.tolerance)
+        if regressions:
+            raise SystemExit(f'{len(regressions)} benchmarks regressed: {", ".join(regressions)}')
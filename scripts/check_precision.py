@@ -0,0 +1,51 @@
+import argparse
+import contextlib
+import io
+from pathlib import Path
+
+import gin
+
+from train import train
+
+
+def final_l1_error(config, gin_params, precision, seeds):
+    # mean over seeds of the test L1 error (sender + recver) over the last epochs
+    gin.clear_config()
+    gin.parse_config_files_and_bindings([str(config)], gin_params + [f'train.precision = "{precision}"'])
+    with contextlib.redirect_stdout(io.StringIO()):
+        errors = train(ensemble_seeds=list(range(seeds)))
+    return sum(errors) / len(errors)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='check that reduced precision training ends with the same '
+                                                 'test L1 error as float32 on the shipped configs')
+    parser.add_argument('--configs', nargs='+', default=None, help='default: every config but the search spaces')
+    parser.add_argument('--gin_param', '-p', nargs='+', default=[])
+    parser.add_argument('--precision', default='bfloat16')
+    parser.add_argument('--seeds', type=int, default=5)
+    parser.add_argument('--rtol', type=float, default=0.)
+    parser.add_argument('--atol', type=float, default=0.5)
+    args = parser.parse_args()
+
+    if args.configs is None:
+        # search spaces have orion priors that gin can't parse
+        configs = sorted(path for path in Path('configs').glob('*.gin')
+                         if path.name != 'base.gin' and not path.name.endswith('-search.gin'))
+    else:
+        configs = [Path(config) for config in args.configs]
+
+    failures = []
+    print(f'{"config":30} {"float32":>10} {args.precision:>10} {"diff":>8}')
+    for config in configs:
+        reference = final_l1_error(config, args.gin_param, 'float32', args.seeds)
+        reduced = final_l1_error(config, args.gin_param, args.precision, args.seeds)
+        diff = reduced - reference
+        matches = abs(diff) <= args.atol + args.rtol * abs(reference)
+        if not matches:
+            failures.append(config.stem)
+        print(f'{config.stem:30} {reference:10.3f} {reduced:10.3f} {diff:+8.3f} {"" if matches else "MISMATCH"}')
+
+    if failures:
+        raise SystemExit(f'{args.precision} does not match float32 on {", ".join(failures)}')
+    print(f'{args.precision} matches float32 on all configs')
@@ -0,0 +1,127 @@
+import argparse
+import csv
+from pathlib import Path
+import sys
+import time
+
+import gin
+import torch
+
+from src.agents import mode
+from src.evaluate import Evaluator, make_evaluator
+from src.game import Game, CircleL1
+# train also registers the configurables used in the configs
+from train import test_agents
+
+
+def _configurable(name):
+    reference = gin.query_parameter(name)
+    return None if reference is None else reference.configurable.wrapper
+
+
+def load_run(run_dir):
+    # rebuild a run's agents from its config.gin and models.save
+    gin.clear_config()
+    gin.parse_config_file(str(run_dir / 'config.gin'), skip_unknown=True)
+
+    Sender = _configurable('train.Sender')
+    Recver = _configurable('train.Recver')
+    Loss = _configurable('train.Loss')
+    vocab_size = gin.query_parameter('train.vocab_size')
+    sender = Sender(input_size=1, output_size=vocab_size, mode=mode.SENDER)
+    recver = Recver(input_size=vocab_size, output_size=1, mode=mode.RECVER)
+
+    models = torch.load(run_dir / 'models.save', map_location='cpu')
+    sender.load_state_dict(models['sender'])
+    recver.load_state_dict(models['recver'])
+
+    run = {'dir': run_dir,
+           'sender': sender,
+           'recver': recver,
+           'vocab_size': vocab_size,
+           'Loss': Loss,
+           'num_points': gin.query_parameter('Game.num_points'),
+           'bias': gin.query_parameter('Game.bias')}
+    # runs with the same architecture are evaluated together as one ensemble
+    run['architecture'] = (Sender, Recver, Loss, vocab_size, run['num_points'],
+                           getattr(sender, 'min_var', None),
+                           tuple((name, tuple(value.shape)) for name, value in sender.state_dict().items()),
+                           tuple((name, tuple(value.shape)) for name, value in recver.state_dict().items()))
+    return run
+
+
+def evaluate_group(runs):
+    # test metrics of runs with the same architecture in one stacked evaluation
+    first = runs[0]
+    gin.clear_config()
+    gin.parse_config_file(str(first['dir'] / 'config.gin'), skip_unknown=True)
+    ensemble_size = len(runs)
+
+    sender = type(first['sender'])(input_size=1, output_size=first['vocab_size'],
+                                   mode=mode.SENDER, ensemble_size=ensemble_size)
+    recver = type(first['recver'])(input_size=first['vocab_size'], output_size=1,
+                                   mode=mode.RECVER, ensemble_size=ensemble_size)
+    for index, run in enumerate(runs):
+        sender.load_member_state_dict(index, run['sender'].state_dict())
+        recver.load_member_state_dict(index, run['recver'].state_dict())
+
+    test_game = Game(num_points=first['num_points'],
+                     bias=[run['bias'] for run in runs],
+                     num_batches=1,
+                     batch_size=100,
+                     training=False,
+                     ensemble_size=ensemble_size)
+    loss_fn = CircleL1(first['num_points']) if first['Loss'] is None else first['Loss'](first['num_points'])
+    evaluator = make_evaluator(sender, first['num_points'], loss_fn)
+
+    send_logs, recv_logs = test_agents(sender, recver, test_game, evaluator,
+                                       first['vocab_size'], torch.device('cpu'))
+    return [({k: v[index] for k, v in send_logs.items()},
+             {k: v[index] for k, v in recv_logs.items()})
+            for index in range(ensemble_size)]
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='test metrics of every finished run under a results dir')
+    parser.add_argument('results_dir')
+    parser.add_argument('--output', '-o', default=None, help='write the table as csv instead of printing it')
+    parser.add_argument('--max_ensemble', type=int, default=256,
+                        help='most runs evaluated together in one stacked evaluation')
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    results_path = Path(args.results_dir)
+    run_dirs = sorted(path.parent for path in results_path.rglob('models.save')
+                      if (path.parent / 'config.gin').exists())
+
+    groups = {}
+    for run_dir in run_dirs:
+        run = load_run(run_dir)
+        groups.setdefault(run['architecture'], []).append(run)
+
+    rows = []
+    for runs in groups.values():
+        for start_index in range(0, len(runs), args.max_ensemble):
+            chunk = runs[start_index:start_index + args.max_ensemble]
+            for run, (send_logs, recv_logs) in zip(chunk, evaluate_group(chunk)):
+                row = {'run': str(run['dir'].relative_to(results_path)),
+                       'sender': type(run['sender']).__name__,
+                       'recver': type(run['recver']).__name__,
+                       'bias': run['bias']}
+                for metric in Evaluator.metrics:
+                    row[f'sender_{metric}'] = send_logs[metric]
+                    row[f'recver_{metric}'] = recv_logs[metric]
+                row['sender_test_entropy'] = send_logs['test_entropy']
+                rows.append(row)
+
+    rows.sort(key=lambda row: row['run'])
+    print(f'evaluated {len(rows)} runs in {len(groups)} architecture groups '
+          f'in {time.perf_counter() - start:.2f}s', file=sys.stderr)
+
+    if rows:
+        f = open(args.output, 'w') if args.output else sys.stdout
+        writer = csv.DictWriter(f, fieldnames=list(rows[0]))
+        writer.writeheader()
+        writer.writerows(rows)
+        if args.output:
+            f.close()
@@ -1,28 +1,37 @@
 import argparse
+from concurrent.futures import ProcessPoolExecutor
 import csv
+from itertools import repeat
+import json
 from pathlib import Path
 import shutil
+import sqlite3
 
 import pandas as pd
 import gin
 
+from src.metrics import LOG_FILES, config_bindings, files_signature, player_logs, read_logs
+
 
 def metric(seeds_dir, error_name='l1', verbose=False):
     # average of last 10 epochs
     results_path = Path(seeds_dir)
 
+    # trials stopped early by orion_runs.py --prune or --divergence_threshold never reached the last epochs
+    if (results_path / 'pruned').exists():
+        return None
+
     # if verbose:
         # print(results_path.name)
 
     run_logs = []
-    for path in results_path.glob('*/logs.json'):
-        # if verbose:
-            # print(path)
-        with open(path, 'r') as logfile:
-            try:
-                run_logs.append(pd.read_json(logfile))
-            except ValueError as e:
-                raise ValueError(f'cant read json {path}: {e}')
+    for run_dir in sorted(path for path in results_path.iterdir() if path.is_dir()):
+        try:
+            columns = read_logs(run_dir)
+        except ValueError as e:
+            raise ValueError(f'cant read logs in {run_dir}: {e}')
+        if columns is not None:
+            run_logs.append(pd.DataFrame(columns))
 
     if not run_logs:
         return None
@@ -33,8 +42,8 @@ def metric(seeds_dir, error_name='l1', verbose=False):
 
     logs = pd.concat(run_logs, ignore_index=True)
     epoch = logs['epoch']
-    sender = pd.DataFrame(logs['sender'].tolist()).join(logs['epoch'])
-    recver = pd.DataFrame(logs['recver'].tolist()).join(logs['epoch'])
+    sender = player_logs(logs, 'sender').join(logs['epoch'])
+    recver = player_logs(logs, 'recver').join(logs['epoch'])
     if error_name == 'l1' and 'test_l1_error' in sender:
         error_metric = 'test_l1_error'
     elif error_name == 'l2' and 'test_l2_error' in sender:
@@ -59,8 +68,112 @@ def metric(seeds_dir, error_name='l1', verbose=False):
             return score
 
 
-def metric_over_runs(all_results_dir, error_name, verbose=True):
+def score_run(result_dir, error_name, verbose=False):
+    # (status, score, l1) of one hyperparameter run, status is 'ok', 'empty' or 'error'
+    try:
+        score = metric(result_dir, error_name, verbose)
+        if error_name != 'l1':
+            l1 = metric(result_dir, 'l1', verbose)
+        else:
+            l1 = score
+    except ValueError:
+        return 'error', None, None
+
+    if score is None:
+        return 'empty', None, None
+    return 'ok', score, l1
+
+
+def score_runs(result_dirs, error_name, verbose=False, workers=1):
+    # score_run for every dir, in the same order, over a process pool with workers > 1
+    if workers > 1 and len(result_dirs) > 1:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            return list(executor.map(score_run, result_dirs, repeat(error_name), repeat(verbose),
+                                     chunksize=max(1, len(result_dirs) // (4 * workers))))
+    return [score_run(result_dir, error_name, verbose) for result_dir in result_dirs]
+
+
+def _signature(result_dir):
+    # size and mtime of every file the score depends on
+    return files_signature(result_dir, sorted([result_dir / 'pruned'] +
+                                              [seed_dir / name for seed_dir in result_dir.iterdir()
+                                               if seed_dir.is_dir() for name in LOG_FILES + ('config.gin',)]))
+
+
+def _config_params(result_dir):
+    # the bindings of the first seed's config.gin as strings
+    config_file = result_dir / '0/config.gin'
+    return config_bindings(config_file) if config_file.exists() else {}
+
+
+class ResultsIndex:
+    # sqlite index of the scores and config of every run in an experiment dir
+    # a run is only scored again when the size or mtime of one of its files changes
+    def __init__(self, results_dir):
+        self.results_path = Path(results_dir)
+        self.db = sqlite3.connect(str(self.results_path / 'results_index.sqlite'))
+        self.db.execute('CREATE TABLE IF NOT EXISTS scores '
+                        '(run TEXT, error_name TEXT, signature TEXT, status TEXT, score REAL, l1 REAL, '
+                        'PRIMARY KEY (run, error_name))')
+        self.db.execute('CREATE TABLE IF NOT EXISTS configs '
+                        '(run TEXT PRIMARY KEY, signature TEXT, params TEXT)')
+
+    def score(self, result_dirs, error_name, verbose=False, workers=1):
+        # (status, score, l1) for every dir, only scoring the new or changed runs
+        signatures = [_signature(result_dir) for result_dir in result_dirs]
+        results = []
+        for result_dir, signature in zip(result_dirs, signatures):
+            row = self.db.execute('SELECT signature, status, score, l1 FROM scores WHERE run = ? AND error_name = ?',
+                                  (result_dir.name, error_name)).fetchone()
+            results.append(tuple(row[1:]) if row is not None and row[0] == signature else None)
+
+        stale = [index for index, result in enumerate(results) if result is None]
+        scores = score_runs([result_dirs[index] for index in stale], error_name, verbose, workers)
+        with self.db:
+            for index, (status, score, l1) in zip(stale, scores):
+                score = None if score is None else float(score)
+                l1 = None if l1 is None else float(l1)
+                results[index] = (status, score, l1)
+                name = result_dirs[index].name
+                self.db.execute('INSERT OR REPLACE INTO scores VALUES (?, ?, ?, ?, ?, ?)',
+                                (name, error_name, signatures[index], status, score, l1))
+                self.db.execute('INSERT OR REPLACE INTO configs VALUES (?, ?, ?)',
+                                (name, signatures[index], json.dumps(_config_params(result_dirs[index]))))
+        return results
+
+    def query(self, error_name):
+        # the indexed runs as they were last scored, without looking at the files
+        return self.db.execute('SELECT run, status, score, l1 FROM scores WHERE error_name = ? ORDER BY run',
+                               (error_name,)).fetchall()
+
+    def params(self, run):
+        row = self.db.execute('SELECT params FROM configs WHERE run = ?', (run,)).fetchone()
+        return None if row is None else json.loads(row[0])
+
+    def close(self):
+        self.db.close()
+
+
+def metric_over_runs(all_results_dir, error_name, verbose=True, index=None, workers=1):
+    # index is None to score every run, 'update' to use the results index and
+    # only score new or changed runs, 'query' to only read the results index
+    # runs are scored in parallel with workers > 1, the result doesn't change
     all_results_path = Path(all_results_dir)
+    # hidden dirs like the .results_cache of src.results aren't runs
+    result_dirs = [result_dir for result_dir in all_results_path.iterdir()
+                   if result_dir.is_dir() and not result_dir.name.startswith('.')]
+
+    if index is None:
+        scores = score_runs(result_dirs, error_name, verbose, workers)
+        runs = [(result_dir.name, *score) for result_dir, score in zip(result_dirs, scores)]
+    else:
+        results_index = ResultsIndex(all_results_path)
+        if index == 'query':
+            runs = results_index.query(error_name)
+        else:
+            scores = results_index.score(result_dirs, error_name, verbose, workers)
+            runs = [(result_dir.name, *score) for result_dir, score in zip(result_dirs, scores)]
+        results_index.close()
 
     empty =  []
     errors = []
@@ -68,26 +181,18 @@ def metric_over_runs(all_results_dir, error_name, verbose=True):
     min_index = None
     min_l1 = None
     num_runs = 0
-    for result_dir in all_results_path.iterdir():
-        if result_dir.is_dir():
-            try:
-                score = metric(result_dir, error_name, verbose)
-                if error_name != 'l1':
-                    l1 = metric(result_dir, 'l1', verbose)
-                else:
-                    l1 = score
-            except ValueError:
-                errors.append(result_dir.name)
-            else:
-                if score is None:
-                    empty.append(result_dir.name)
-                elif min_score is None or score < min_score:
-                    min_score = score
-                    min_index = result_dir.name
-                    min_l1 = l1
-                    num_runs += 1
-                else:
-                    num_runs += 1
+    for name, status, score, l1 in runs:
+        if status == 'error':
+            errors.append(name)
+        elif status == 'empty':
+            empty.append(name)
+        elif min_score is None or score < min_score:
+            min_score = score
+            min_index = name
+            min_l1 = l1
+            num_runs += 1
+        else:
+            num_runs += 1
 
     if verbose:
         print(f'Empty dirs {empty}')
@@ -97,7 +202,8 @@ def metric_over_runs(all_results_dir, error_name, verbose=True):
     return min_score, min_index, min_l1
 
 
-def generate_results_csv(experiment_name, cluster_dir, output_dir='.', error_name='l1', verbose=False):
+def generate_results_csv(experiment_name, cluster_dir, output_dir='.', error_name='l1', verbose=False, index=None,
+                         workers=1):
     output_path = Path(output_dir)
     cluster_results_path = Path(cluster_dir)
     if not cluster_results_path.exists():
@@ -114,7 +220,8 @@ def generate_results_csv(experiment_name, cluster_dir, output_dir='.', error_nam
         bias_index = exp_full_name.find('bias') + 4
         name_index = len(exp_full_name) + 1
         print(f'running on {exp_full_name}')
-        error, run_name, l1 = metric_over_runs(exp_results_path, error_name=error_name, verbose=verbose)
+        error, run_name, l1 = metric_over_runs(exp_results_path, error_name=error_name, verbose=verbose,
+                                               index=index, workers=workers)
         if error is None:
             print(f'no results in {exp_full_name}')
         else:
@@ -136,12 +243,14 @@ def generate_results_csv(experiment_name, cluster_dir, output_dir='.', error_nam
     return run_paths
 
 
-def generate_results_folder(experiment_name, cluster_dir, output_path, error_name, verbose=False):
+def generate_results_folder(experiment_name, cluster_dir, output_path, error_name, verbose=False, index=None,
+                            workers=1):
     output_path = Path(output_path)
     output_path.mkdir(exist_ok=True)
 
     print('generating results csv')
-    best_run_paths = generate_results_csv(experiment_name, cluster_dir, output_path, error_name, verbose)
+    best_run_paths = generate_results_csv(experiment_name, cluster_dir, output_path, error_name, verbose, index,
+                                          workers)
 
     print('copying files')
     for run_path in best_run_paths:
@@ -163,12 +272,20 @@ if __name__ == '__main__':
     gen_parser.add_argument('--output-dir', default=None)
     gen_parser.add_argument('--error', default='l1')
     gen_parser.add_argument('--verbose', action='store_true')
+    gen_parser.add_argument('--index', choices=['update', 'query'], default=None,
+                            help='keep scores in results_index.sqlite in every experiment dir, '
+                                 'update only rescores new or changed runs, query only reads the index')
+    gen_parser.add_argument('--workers', type=int, default=1, help='score runs in parallel processes')
 
     # get error metric over hyperparams
     check_parser = subparsers.add_parser('check')
     check_parser.set_defaults(command='check')
     check_parser.add_argument('dir')
     check_parser.add_argument('--error', default='l1')
+    check_parser.add_argument('--index', choices=['update', 'query'], default=None,
+                              help='keep scores in results_index.sqlite in the dir, '
+                                   'update only rescores new or changed runs, query only reads the index')
+    check_parser.add_argument('--workers', type=int, default=1, help='score runs in parallel processes')
 
     args = parser.parse_args()
 
@@ -177,6 +294,8 @@ if __name__ == '__main__':
                                 args.results_dir,
                                 args.output_dir,
                                 args.error,
-                                args.verbose)
+                                args.verbose,
+                                args.index,
+                                args.workers)
     elif args.command == 'check':
-        print(metric_over_runs(args.dir, args.error))
+        print(metric_over_runs(args.dir, args.error, index=args.index, workers=args.workers))
@@ -8,138 +8,345 @@ import torch.nn.functional as F
 from torch.distributions.categorical import Categorical
 from torch.distributions import Normal, MultivariateNormal
 
+from src.distributed import all_reduce_mean
+
 mode = Enum('Player', 'SENDER RECVER')
 
-def relaxedembedding(x, weight, *args):
-    if isinstance(x, torch.LongTensor) or (torch.cuda.is_available() and isinstance(x, torch.cuda.LongTensor)):
-        return F.embedding(x, weight, *args)
-    else:
-        return torch.matmul(x, weight)
+class RelaxedEmbedding(nn.Embedding):
+    # integer messages are looked up, relaxed (one-hot or soft) messages are multiplied
+    # the dtype check works for every device and doesn't go through isinstance dispatch
+    # with sparse=True the lookups of integer messages give a sparse gradient
+    # over only the rows that were used, relaxed messages always give a dense one
+    def forward(self, x):
+        if x.is_floating_point():
+            return torch.matmul(x, self.weight)
+        else:
+            return F.embedding(x, self.weight, self.padding_idx, self.max_norm, self.norm_type,
+                               self.scale_grad_by_freq, self.sparse)
 
 
-class RelaxedEmbedding(nn.Embedding):
+# nn.Linear with independent weights per ensemble member
+# inputs are (members, batch, features) and the weight is stored as (members, in, out)
+class EnsembleLinear(nn.Module):
+    def __init__(self, ensemble_size, in_features, out_features):
+        super().__init__()
+        self.ensemble_size = ensemble_size
+        self.in_features = in_features
+        self.out_features = out_features
+        self.weight = nn.Parameter(torch.empty(ensemble_size, in_features, out_features))
+        self.bias = nn.Parameter(torch.empty(ensemble_size, 1, out_features))
+        self.reset_parameters()
+
+    def reset_parameters(self, generator=None):
+        # same distribution as nn.Linear's default init
+        bound = 1 / math.sqrt(self.in_features)
+        with torch.no_grad():
+            self.weight.uniform_(-bound, bound, generator=generator)
+            self.bias.uniform_(-bound, bound, generator=generator)
+
     def forward(self, x):
-        if isinstance(x, torch.LongTensor) or (torch.cuda.is_available() and isinstance(x, torch.cuda.LongTensor)):
-            return F.embedding(x, self.weight, self.padding_idx, self.max_norm, self.norm_type, self.scale_grad_by_freq, self.sparse)
+        return torch.baddbmm(self.bias, x, self.weight)
+
+    def member_state(self, index):
+        return {'weight': self.weight[index].t(),
+                'bias': self.bias[index, 0]}
+
+    def load_member_state(self, index, state):
+        with torch.no_grad():
+            self.weight[index].copy_(state['weight'].t())
+            self.bias[index, 0].copy_(state['bias'])
+
+
+class _EnsembleLookup(torch.autograd.Function):
+    # weight[members, x] with a sparse (members, num_embeddings) x embedding_dim gradient
+    @staticmethod
+    def forward(ctx, weight, x):
+        members = torch.arange(weight.size(0), device=x.device).view(-1, *[1] * (x.dim() - 1)).expand_as(x)
+        ctx.save_for_backward(members, x)
+        ctx.weight_shape = weight.shape
+        return weight[members, x]
+
+    @staticmethod
+    def backward(ctx, grad):
+        members, x = ctx.saved_tensors
+        indices = torch.stack([members.reshape(-1), x.reshape(-1)])
+        values = grad.reshape(-1, ctx.weight_shape[-1])
+        return torch.sparse_coo_tensor(indices, values, ctx.weight_shape, check_invariants=False), None
+
+
+# RelaxedEmbedding with an independent table per ensemble member
+class EnsembleRelaxedEmbedding(nn.Module):
+    def __init__(self, ensemble_size, num_embeddings, embedding_dim, sparse=False):
+        super().__init__()
+        self.ensemble_size = ensemble_size
+        self.num_embeddings = num_embeddings
+        self.embedding_dim = embedding_dim
+        self.sparse = sparse
+        self.weight = nn.Parameter(torch.empty(ensemble_size, num_embeddings, embedding_dim))
+        self.reset_parameters()
+
+    def reset_parameters(self, generator=None):
+        with torch.no_grad():
+            self.weight.normal_(generator=generator)
+
+    def forward(self, x):
+        if x.is_floating_point():
+            return torch.bmm(x, self.weight)
+        elif self.sparse:
+            return _EnsembleLookup.apply(self.weight, x)
         else:
-            return torch.matmul(x, self.weight)
+            members = torch.arange(self.ensemble_size, device=x.device).unsqueeze(1)
+            return self.weight[members, x]
+
+    def member_state(self, index):
+        return {'weight': self.weight[index]}
+
+    def load_member_state(self, index, state):
+        with torch.no_grad():
+            self.weight[index].copy_(state['weight'])
+
+
+def _linear(in_features, out_features, ensemble_size=None):
+    if ensemble_size is None:
+        return nn.Linear(in_features, out_features)
+    else:
+        return EnsembleLinear(ensemble_size, in_features, out_features)
+
+
+def _embedding(num_embeddings, embedding_dim, ensemble_size=None, sparse=False):
+    if ensemble_size is None:
+        return RelaxedEmbedding(num_embeddings, embedding_dim, sparse=sparse)
+    else:
+        return EnsembleRelaxedEmbedding(ensemble_size, num_embeddings, embedding_dim, sparse=sparse)
 
 
 class Policy(nn.Module):
-    def __init__(self, mode, *args, **kwargs):
+    def __init__(self, mode, *args, ensemble_size=None, **kwargs):
         super().__init__()
         self.mode = mode
+        self.ensemble_size = ensemble_size
+        # sampling stream of a single run and per-member streams of ensembles,
+        # the global stream is only used when they're None
+        self.generator = None
+        self.generators = None
+        # dtype for autocast of the networks, None for float32
+        self.precision = None
+        # data parallel training averages the baseline's batch errors over ranks
+        self.distributed = False
 
     def forward(self, state):
         pass
 
+    def _network(self, fn, x):
+        # only the network runs in reduced precision, its outputs are cast back so
+        # distributions, log-probs, the losses and the baseline stay float32
+        if self.precision is None:
+            return fn(x)
+        with torch.autocast(x.device.type, dtype=self.precision):
+            output = fn(x)
+        if isinstance(output, tuple):
+            return tuple(value.float() for value in output)
+        return output.float()
+
+    def reset_parameters(self, generator):
+        # the default init of every layer, in the order the layers were built, drawn from
+        # generator, so seeding it gives the same weights as torch.manual_seed before building
+        for module in self.modules():
+            if isinstance(module, (EnsembleLinear, EnsembleRelaxedEmbedding)):
+                module.reset_parameters(generator)
+            elif isinstance(module, nn.Linear):
+                bound = 1 / math.sqrt(module.in_features)
+                with torch.no_grad():
+                    module.weight.uniform_(-bound, bound, generator=generator)
+                    module.bias.uniform_(-bound, bound, generator=generator)
+            elif isinstance(module, nn.Embedding):
+                with torch.no_grad():
+                    module.weight.normal_(generator=generator)
+
     def loss(self, error, **kwargs):
-        logs = {'error': error.mean().item()}
+        logs = {'error': self._log(self._member_mean(error))}
 
         return None, logs
 
+    def _member_mean(self, x):
+        # mean over everything but the leading ensemble dimension
+        if self.ensemble_size is None:
+            return x.mean()
+        else:
+            return x.reshape(self.ensemble_size, -1).mean(-1)
+
+    def _log(self, value):
+        # logs stay on device, train() syncs them once per epoch
+        return value.detach()
+
+    def _init_baseline(self):
+        # float64 like the python float the baseline used to be, so seeded runs keep their
+        # results, _advantage casts it to the dtype of the errors
+        if self.ensemble_size is None:
+            baseline = torch.zeros((), dtype=torch.float64)
+        else:
+            baseline = torch.zeros(self.ensemble_size, 1, dtype=torch.float64)
+        # not part of the state dict so models.save files keep their format
+        self.register_buffer('baseline', baseline, persistent=False)
+        self.register_buffer('n_update', torch.zeros((), dtype=torch.float64), persistent=False)
+
+    def _advantage(self, error):
+        return error.detach() - self.baseline.to(error.dtype)
+
+    def _update_baseline(self, error):
+        self.n_update += 1
+        error_mean = self._member_mean(error.detach())
+        if self.distributed:
+            error_mean = all_reduce_mean(error_mean)
+        error_mean = error_mean.double()
+        if self.ensemble_size is not None:
+            error_mean = error_mean.unsqueeze(1)
+        # out of place so a compiled backward never sees the updated baseline
+        self.baseline = self.baseline + (error_mean - self.baseline) / self.n_update
+
+    # state dict of one ensemble member in the format of the non-ensemble policy
+    def member_state_dict(self, index):
+        state = {}
+        for name, module in self.named_modules():
+            if isinstance(module, (EnsembleLinear, EnsembleRelaxedEmbedding)):
+                for key, value in module.member_state(index).items():
+                    state[f'{name}.{key}'] = value.detach().clone()
+        return state
+
+    def load_member_state_dict(self, index, state):
+        for name, module in self.named_modules():
+            if isinstance(module, (EnsembleLinear, EnsembleRelaxedEmbedding)):
+                prefix = f'{name}.'
+                module.load_member_state(index, {key[len(prefix):]: value
+                                                 for key, value in state.items()
+                                                 if key.startswith(prefix)})
+
 
 @gin.configurable
 class Deterministic(Policy):
+    # sparse=True only updates the embedding rows of the messages in the batch,
+    # for large vocab_size with discrete messages (train uses SparseAdam for them)
     def __init__(self, input_size, output_size, hidden_size,
-                 lr, num_layers=2, **kwargs):
+                 lr, num_layers=2, sparse=False, **kwargs):
         super().__init__(**kwargs)
         self.num_layers = num_layers
+        ensemble_size = self.ensemble_size
         if self.num_layers == 1:
-            self.policy = RelaxedEmbedding(input_size, output_size)
+            self.policy = _embedding(input_size, output_size, ensemble_size, sparse)
         elif self.num_layers == 2:
             self.policy = nn.Sequential(
-                RelaxedEmbedding(input_size, hidden_size),
+                _embedding(input_size, hidden_size, ensemble_size, sparse),
                 nn.ReLU(),
-                nn.Linear(hidden_size, output_size))
+                _linear(hidden_size, output_size, ensemble_size))
         else:
             self.policy = nn.Sequential(
-                RelaxedEmbedding(input_size, hidden_size),
+                _embedding(input_size, hidden_size, ensemble_size, sparse),
                 nn.ReLU(),
-                nn.Linear(hidden_size, hidden_size),
+                _linear(hidden_size, hidden_size, ensemble_size),
                 nn.ReLU(),
-                nn.Linear(hidden_size, output_size))
+                _linear(hidden_size, output_size, ensemble_size))
         self.lr = lr
 
     def forward(self, state):
-        action = self.policy(state)
+        action = self._network(self.policy, state)
 
         return action, torch.tensor(0.), torch.tensor(0.)
 
     def loss(self, error, *args):
         _, logs = super().loss(error)
-        loss = error.mean()
+        loss = self._member_mean(error)
 
-        logs['loss'] = loss.item()
+        logs['loss'] = self._log(loss)
 
-        return loss, logs
+        return loss.sum(), logs
 
 
 @gin.configurable
 class Reinforce(Policy):
+    # cdf_sampling=True samples messages by inverting the cdf with one uniform per sample,
+    # instead of torch.multinomial's one random draw per vocabulary entry, which is most
+    # of the step for large vocab_size (same distribution, different random stream)
     def __init__(self, input_size, output_size, hidden_size,
-                 lr, ent_reg, num_layers=2, **kwargs):
+                 lr, ent_reg, num_layers=2, cdf_sampling=False, **kwargs):
         super().__init__(**kwargs)
         self.input_size = input_size
         self.output_size = output_size
         self.num_layers = num_layers
+        ensemble_size = self.ensemble_size
         if self.num_layers == 1:
             self.policy = nn.Sequential(
-                nn.Linear(input_size, output_size),
-                nn.LogSoftmax(dim=1))
+                _linear(input_size, output_size, ensemble_size),
+                nn.LogSoftmax(dim=-1))
         elif self.num_layers == 2:
             self.policy = nn.Sequential(
-                nn.Linear(input_size, hidden_size),
+                _linear(input_size, hidden_size, ensemble_size),
                 nn.ReLU(),
-                nn.Linear(hidden_size, output_size),
-                nn.LogSoftmax(dim=1))
+                _linear(hidden_size, output_size, ensemble_size),
+                nn.LogSoftmax(dim=-1))
         else:
             self.policy = nn.Sequential(
-                nn.Linear(input_size, hidden_size),
+                _linear(input_size, hidden_size, ensemble_size),
                 nn.ReLU(),
-                nn.Linear(hidden_size, hidden_size),
+                _linear(hidden_size, hidden_size, ensemble_size),
                 nn.ReLU(),
-                nn.Linear(hidden_size, output_size),
-                nn.LogSoftmax(dim=1))
+                _linear(hidden_size, output_size, ensemble_size),
+                nn.LogSoftmax(dim=-1))
 
         self.ent_reg = ent_reg
         self.lr = lr
-        self.baseline = 0.
-        self.n_update = 0.
+        self.cdf_sampling = cdf_sampling
+        self._init_baseline()
+
+    def _cdf_sample(self, probs):
+        cdf = probs.cumsum(-1)
+        if self.generators is None:
+            uniform = torch.rand(cdf.shape[:-1] + (1,), device=cdf.device, generator=self.generator)
+        else:
+            uniform = torch.stack([torch.rand(cdf.shape[1:-1] + (1,), device=cdf.device, generator=generator)
+                                   for generator in self.generators])
+        # the first message whose cdf is above the uniform, clamped for rounding at the end
+        sample = torch.searchsorted(cdf, uniform * cdf[..., -1:], right=True).squeeze(-1)
+        return sample.clamp_(max=cdf.size(-1) - 1)
 
     def forward(self, state):
-        logits = self.policy(state)
+        logits = self._network(self.policy, state)
         dist = Categorical(logits=logits)
         entropy = dist.entropy()
 
         if self.training:
-            sample = dist.sample()
+            if self.cdf_sampling:
+                sample = self._cdf_sample(dist.probs)
+            elif self.generators is None:
+                # the same draws as dist.sample() but from the run's generator
+                sample = torch.multinomial(dist.probs, 1, True, generator=self.generator).squeeze(-1)
+            else:
+                sample = torch.stack([torch.multinomial(probs, 1, True, generator=generator).squeeze(-1)
+                                      for probs, generator in zip(dist.probs, self.generators)])
         else:
-            sample = logits.argmax(dim=1)
+            sample = logits.argmax(dim=-1)
 
         logprobs = dist.log_prob(sample)
 
         return sample, logprobs, entropy
 
     def forward_dist(self, state):
-        logits = self.policy(state)
+        logits = self._network(self.policy, state)
         return Categorical(logits=logits)
 
     def loss(self, error, logprobs, entropy):
         _, logs = super().loss(error)
 
-        policy_loss = ((error.detach() - self.baseline) * logprobs).mean()
-        entropy_loss = -entropy.mean() * self.ent_reg
+        policy_loss = self._member_mean(self._advantage(error) * logprobs)
+        entropy_loss = -self._member_mean(entropy) * self.ent_reg
         loss = policy_loss + entropy_loss
 
-        logs['loss'] = loss.item()
-        logs['entropy'] = entropy.mean().item()
+        logs['loss'] = self._log(loss)
+        logs['entropy'] = self._log(self._member_mean(entropy))
 
         if self.training:
-            self.n_update += 1.
-            self.baseline += (error.detach().mean().item() - self.baseline) / (self.n_update)
+            self._update_baseline(error)
 
-        return loss, logs
+        return loss.sum(), logs
 
 
 @gin.configurable
@@ -148,43 +355,52 @@ class Gaussian(Policy):
                  lr, ent_reg, dim=1, num_layers=3, min_var=1e-2, **kwargs):
         super().__init__(**kwargs)
         self.num_layers = num_layers
+        ensemble_size = self.ensemble_size
         if self.num_layers == 2:
             self.policy = nn.Sequential(
-                nn.Linear(input_size, hidden_size),
+                _linear(input_size, hidden_size, ensemble_size),
                 nn.ReLU())
         elif self.num_layers == 3:
             self.policy = nn.Sequential(
-                nn.Linear(input_size, hidden_size),
+                _linear(input_size, hidden_size, ensemble_size),
                 nn.ReLU(),
-                nn.Linear(hidden_size, hidden_size),
+                _linear(hidden_size, hidden_size, ensemble_size),
                 nn.ReLU())
         else:
             raise NotImplementedError('only support 2 or 3-layer nets')
 
-        self.mean = nn.Linear(hidden_size, dim)
+        self.mean = _linear(hidden_size, dim, ensemble_size)
         self.var = nn.Sequential(
-            nn.Linear(hidden_size, dim),
+            _linear(hidden_size, dim, ensemble_size),
             nn.ReLU())
 
         self.ent_reg = ent_reg
         self.lr = lr
         self.dim = dim
         self.min_var = min_var
-        self.baseline = 0.
-        self.n_update = 0.
+        self._init_baseline()
+
+    def _mean_var(self, state):
+        logits = self.policy(state)
+        return self.mean(logits), self.var(logits)
 
     def forward(self, state):
         device = state.device
-        logits = self.policy(state)
-        mean = self.mean(logits)
-        var = self.var(logits) + self.min_var
+        mean, var = self._network(self._mean_var, state)
+        var = var + self.min_var
 
         dist = Normal(mean, var)
 
         entropy = dist.entropy()
 
         if self.training:
-            sample = dist.rsample()
+            if self.generators is None:
+                # the same draws as dist.rsample() but from the run's generator
+                sample = mean + torch.empty_like(mean).normal_(generator=self.generator) * var
+            else:
+                noise = torch.stack([torch.randn(mean.shape[1:], device=device, generator=generator)
+                                     for generator in self.generators])
+                sample = mean + var * noise
         else:
             sample = mean
 
@@ -193,12 +409,11 @@ class Gaussian(Policy):
         return sample, logprobs, entropy
 
     def forward_dist(self, state):
-        logits = self.policy(state)
-        mean = self.mean(logits)
-        var = self.var(logits) + self.min_var
+        mean, var = self._network(self._mean_var, state)
+        var = var + self.min_var
 
-        iso_mean = torch.mean(mean, dim=1, keepdim=True)
-        iso_var = torch.mean(var, dim=1, keepdim=True)
+        iso_mean = torch.mean(mean, dim=-1, keepdim=True)
+        iso_var = torch.mean(var, dim=-1, keepdim=True)
         def cdf(value):
             return 0.5 * (1 + torch.erf((value - iso_mean) * iso_var.reciprocal() / math.sqrt(2)))
 
@@ -209,15 +424,18 @@ class Gaussian(Policy):
     def loss(self, error, logprobs, entropy):
         _, logs = super().loss(error)
 
-        policy_loss = ((error.detach() - self.baseline) * logprobs).mean()
-        entropy_loss = -entropy.mean() * self.ent_reg
+        advantage = self._advantage(error)
+        if self.ensemble_size is not None:
+            # logprobs are (..., batch, dim) so keep the same broadcast as a single model
+            advantage = advantage.unsqueeze(-2)
+        policy_loss = self._member_mean(advantage * logprobs)
+        entropy_loss = -self._member_mean(entropy) * self.ent_reg
         loss = policy_loss + entropy_loss
 
-        logs['loss'] = loss.item()
-        logs['entropy'] = entropy.mean().item()
+        logs['loss'] = self._log(loss)
+        logs['entropy'] = self._log(self._member_mean(entropy))
 
         if self.training:
-            self.n_update += 1.
-            self.baseline += (error.detach().mean().item() - self.baseline) / (self.n_update)
+            self._update_baseline(error)
 
-        return loss, logs
+        return loss.sum(), logs
@@ -0,0 +1,109 @@
+import os
+import threading
+
+import torch
+
+from src.metrics import parse_bindings
+
+
+# bindings that only change how long a run trains and how it is saved, timed or
+# reported, a checkpoint can be resumed with other values for them
+RESUMABLE_BINDINGS = ('train.num_epochs', 'train.savedir', 'train.loaddir', 'train.checkpoint_every',
+                      'train.epoch_callback', 'train.time_phases', 'train.profile_epochs',
+                      'train.profile_trace', 'train.status_interval')
+
+
+def _to_cpu(value):
+    # a copy that training can't modify while it is being written
+    if isinstance(value, torch.Tensor):
+        return value.detach().to('cpu', copy=True)
+    if isinstance(value, dict):
+        return {k: _to_cpu(v) for k, v in value.items()}
+    if isinstance(value, (list, tuple)):
+        return type(value)(_to_cpu(v) for v in value)
+    return value
+
+
+def buffers_state(module):
+    # state_dict skips the non-persistent REINFORCE baseline and n_update
+    return dict(module.named_buffers())
+
+
+def load_buffers_state(module, state):
+    device = next(module.parameters()).device
+    for name, value in state.items():
+        module_name, _, buffer_name = name.rpartition('.')
+        # the baseline is updated out of place, so replace the buffer instead of copying into it
+        setattr(module.get_submodule(module_name), buffer_name, value.to(device))
+
+
+def rng_state(generators):
+    # a run only draws from its own generators
+    return {'generators': [generator.get_state() for generator in generators]}
+
+
+def checkpoint_bindings(config_str):
+    # the bindings of the operative config that a resumed run has to share with its checkpoint
+    return {name: value for name, value in parse_bindings(config_str).items()
+            if name not in RESUMABLE_BINDINGS}
+
+
+def check_bindings(checkpoint, bindings):
+    # checkpoints from before the bindings were saved can't be checked
+    saved = checkpoint.get('config')
+    if saved is None:
+        return
+    changed = sorted(name for name in saved.keys() | bindings.keys() if saved.get(name) != bindings.get(name))
+    if changed:
+        raise ValueError('the checkpoint was saved with another config, '
+                         + ', '.join(f'{name} = {saved.get(name)} (now {bindings.get(name)})' for name in changed)
+                         + ', remove it or use another savedir to start a new run')
+
+
+def load_rng_state(state, generators):
+    for generator, generator_state in zip(generators, state['generators']):
+        generator.set_state(generator_state)
+
+
+class Checkpointer:
+    # writes checkpoints on a background thread so training doesn't wait for the disk
+    # every file is written to a temporary path and renamed, so a job killed
+    # mid-write leaves the previous checkpoint intact
+    def __init__(self, path):
+        self.path = path
+        self.thread = None
+        self.error = None
+
+    def exists(self):
+        return os.path.exists(self.path)
+
+    def load(self):
+        # the checkpoint holds rng states and logs, not just tensors
+        try:
+            return torch.load(self.path, weights_only=False)
+        except TypeError:
+            return torch.load(self.path)
+
+    def save(self, state):
+        state = _to_cpu(state)
+        # at most one write in flight, a slow disk throttles training instead of piling up copies
+        self.wait()
+        self.thread = threading.Thread(target=self._write, args=(state,), daemon=True)
+        self.thread.start()
+
+    def _write(self, state):
+        # an exception would end with the daemon thread, wait() raises it in training instead
+        try:
+            tmp_path = f'{self.path}.tmp'
+            torch.save(state, tmp_path)
+            os.replace(tmp_path, self.path)
+        except Exception as error:
+            self.error = error
+
+    def wait(self):
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise RuntimeError(f'writing the checkpoint {self.path} failed') from error
@@ -0,0 +1,171 @@
+import argparse
+import copy
+import warnings
+
+import gin
+import torch
+from torch.optim import Adam, SparseAdam
+
+from src.agents import mode
+from src.game import Game, CircleL1
+
+
+def step_losses(sender, recver, loss_fn, send_target, recv_target, timer=None):
+    # everything in a training step before the backward pass
+    # the optional PhaseTimer is only for the eager step, it can't be compiled
+    message, send_logprobs, send_entropy = sender(send_target)
+    message = message.detach()
+    if timer is not None:
+        timer.lap('sender_forward')
+    action, recv_logprobs, recv_entropy = recver(message)
+    if timer is not None:
+        timer.lap('recver_forward')
+    send_error = loss_fn(action, send_target).squeeze(-1)
+    recv_error = loss_fn(action, recv_target).squeeze(-1)
+
+    send_loss, send_logs = sender.loss(send_error, send_logprobs, send_entropy)
+    recv_loss, recv_logs = recver.loss(recv_error, recv_logprobs, recv_entropy)
+    if timer is not None:
+        timer.lap('loss')
+
+    return send_loss, recv_loss, send_logs, recv_logs
+
+
+def compile_step_losses():
+    if not hasattr(torch, 'compile'):
+        warnings.warn('torch.compile needs torch>=2.0, using the eager training step')
+        return step_losses
+
+    return torch.compile(step_losses)
+
+
+def make_adam(params, lr, fused=False):
+    # fused Adam on cpu needs torch>=2.4, fall back to the multi-tensor version
+    if fused:
+        try:
+            return Adam(params, lr=lr, fused=True)
+        except (RuntimeError, TypeError):
+            return Adam(params, lr=lr, foreach=True)
+
+    return Adam(params, lr=lr)
+
+
+class SparseDenseAdam:
+    # Adam for the dense parameters and SparseAdam for the sparse embedding tables,
+    # so only the rows of the messages in the batch are updated
+    def __init__(self, dense_params, sparse_params, lr, fused=False):
+        self.optimizers = [SparseAdam(sparse_params, lr=lr)]
+        if dense_params:
+            self.optimizers.insert(0, make_adam(dense_params, lr, fused))
+
+    @property
+    def param_groups(self):
+        return [group for optimizer in self.optimizers for group in optimizer.param_groups]
+
+    @property
+    def state(self):
+        return {param: state for optimizer in self.optimizers for param, state in optimizer.state.items()}
+
+    def zero_grad(self):
+        for optimizer in self.optimizers:
+            optimizer.zero_grad()
+
+    def step(self):
+        for optimizer in self.optimizers:
+            optimizer.step()
+
+    def state_dict(self):
+        return [optimizer.state_dict() for optimizer in self.optimizers]
+
+    def load_state_dict(self, state):
+        for optimizer, optimizer_state in zip(self.optimizers, state):
+            optimizer.load_state_dict(optimizer_state)
+
+
+def make_optimizer(agent, fused=False):
+    # Adam with the agent's lr, with SparseAdam for its sparse embeddings
+    sparse_params = [module.weight for module in agent.modules() if getattr(module, 'sparse', False)]
+    if not sparse_params:
+        return make_adam(agent.parameters(), agent.lr, fused)
+
+    sparse_ids = {id(param) for param in sparse_params}
+    dense_params = [param for param in agent.parameters() if id(param) not in sparse_ids]
+    return SparseDenseAdam(dense_params, sparse_params, agent.lr, fused)
+
+
+def compiled_step(step_fn, send_opt, recv_opt, *args):
+    send_loss, recv_loss, send_logs, recv_logs = step_fn(*args)
+
+    # the message is detached so the two losses have disjoint graphs
+    # and one backward pass gives the same gradients as two
+    send_opt.zero_grad()
+    recv_opt.zero_grad()
+    (send_loss + recv_loss).backward()
+    send_opt.step()
+    recv_opt.step()
+
+    return send_logs, recv_logs
+
+
+def check_parity(Sender, Recver, vocab_size, num_steps=20, batch_size=64, Loss=None,
+                 random_seed=0, rtol=1e-4, atol=1e-5):
+    # follow an eager training run and at every step compare its losses and gradients
+    # with the compiled step on a copy of the same agents and the same samples
+    # (a whole compiled run can't be compared since REINFORCE samples diverge on tiny differences)
+    import torch._inductor.config
+    torch._inductor.config.fallback_random = True
+    torch.manual_seed(random_seed)
+
+    game = Game(num_batches=num_steps, batch_size=batch_size)
+    loss_fn = CircleL1(game.num_points) if Loss is None else Loss(game.num_points)
+    sender = Sender(input_size=1, output_size=vocab_size, mode=mode.SENDER)
+    recver = Recver(input_size=vocab_size, output_size=1, mode=mode.RECVER)
+    send_opt = make_optimizer(sender)
+    recv_opt = make_optimizer(recver)
+    compiled_fn = compile_step_losses()
+
+    matches = True
+    max_diff = 0.
+    for step, (send_target, recv_target) in enumerate(game):
+        results = []
+        runs = ((compiled_fn, copy.deepcopy(sender), copy.deepcopy(recver)),
+                (step_losses, sender, recver))
+        for step_fn, run_sender, run_recver in runs:
+            torch.manual_seed(random_seed + step)
+            send_loss, recv_loss, _, _ = step_fn(run_sender, run_recver, loss_fn,
+                                                 send_target, recv_target)
+            run_sender.zero_grad()
+            run_recver.zero_grad()
+            (send_loss + recv_loss).backward()
+            results.append([torch.stack([send_loss, recv_loss]).detach()] +
+                           [param.grad for param in run_sender.parameters()] +
+                           [param.grad for param in run_recver.parameters()])
+
+        for compiled_value, eager_value in zip(*results):
+            max_diff = max(max_diff, (compiled_value - eager_value).abs().max().item())
+            matches = matches and torch.allclose(compiled_value, eager_value, rtol=rtol, atol=atol)
+
+        send_opt.step()
+        recv_opt.step()
+
+    print(f'max loss/gradient difference over {num_steps} steps: {max_diff:.2e}')
+
+    return matches
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='check that the compiled training step matches eager')
+    parser.add_argument('--gin_file', '-f', nargs='+')
+    parser.add_argument('--gin_param', '-p', nargs='+')
+    args = parser.parse_args()
+
+    # registers the train configurable used by the config files
+    import train
+    gin.parse_config_files_and_bindings(args.gin_file, args.gin_param)
+
+    Sender = gin.query_parameter('train.Sender').configurable.wrapper
+    Recver = gin.query_parameter('train.Recver').configurable.wrapper
+    vocab_size = gin.query_parameter('train.vocab_size')
+    if not check_parity(Sender, Recver, vocab_size):
+        raise SystemExit('compiled training step does not match eager')
+    print('compiled training step matches eager')
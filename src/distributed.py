@@ -0,0 +1,120 @@
+import argparse
+import os
+import sys
+
+import gin
+import torch
+import torch.distributed as dist
+import torch.multiprocessing as mp
+
+
+def is_distributed():
+    return dist.is_available() and dist.is_initialized() and dist.get_world_size() > 1
+
+
+def rank():
+    return dist.get_rank() if is_distributed() else 0
+
+
+def world_size():
+    return dist.get_world_size() if is_distributed() else 1
+
+
+def rank_seed(seed, rank):
+    # rank 0 keeps the seed, so a single process run is unchanged
+    return seed + rank * 2 ** 32
+
+
+def all_reduce_mean(tensor):
+    # mean over ranks, out of place
+    tensor = tensor.clone()
+    dist.all_reduce(tensor)
+    return tensor / dist.get_world_size()
+
+
+def broadcast_parameters(module):
+    # every rank starts from the parameters of rank 0
+    with torch.no_grad():
+        for param in module.parameters():
+            dist.broadcast(param, src=0)
+
+
+def average_gradients(module):
+    # one all-reduce of all the dense gradients flattened together,
+    # sparse embedding gradients are reduced on their own and stay sparse
+    grads = []
+    for param in module.parameters():
+        if param.grad is None:
+            continue
+        if param.grad.is_sparse:
+            grad = param.grad.coalesce()
+            dist.all_reduce(grad)
+            param.grad = grad / dist.get_world_size()
+        else:
+            grads.append(param.grad)
+    if not grads:
+        return
+    flat = torch.cat([grad.reshape(-1) for grad in grads])
+    dist.all_reduce(flat)
+    flat /= dist.get_world_size()
+    offset = 0
+    for grad in grads:
+        grad.copy_(flat[offset:offset + grad.numel()].view_as(grad))
+        offset += grad.numel()
+
+
+def average_logs(logs):
+    # epoch means of the training metrics over the shards of all ranks
+    if not logs:
+        return logs
+    keys = list(logs)
+    values = all_reduce_mean(torch.tensor([logs[key] for key in keys], dtype=torch.float64))
+    return dict(zip(keys, values.tolist()))
+
+
+def all_gather(obj):
+    # list of every rank's picklable obj
+    objs = [None] * dist.get_world_size()
+    dist.all_gather_object(objs, obj)
+    return objs
+
+
+def _run(rank, world_size, master_addr, master_port, gin_files, gin_params):
+    os.environ['MASTER_ADDR'] = master_addr
+    os.environ['MASTER_PORT'] = str(master_port)
+    dist.init_process_group('gloo', rank=rank, world_size=world_size)
+    _train(gin_files, gin_params)
+
+
+def _train(gin_files, gin_params):
+    # train also registers the configurables used in the configs
+    from train import train
+
+    # the other ranks print the same averaged logs as rank 0
+    if dist.get_rank() != 0:
+        sys.stdout = open(os.devnull, 'w')
+    try:
+        gin.parse_config_files_and_bindings(gin_files, gin_params)
+        train()
+    finally:
+        dist.destroy_process_group()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='data parallel training on the gloo backend, every rank trains '
+                                                 'on its own shard of train.batch_size')
+    parser.add_argument('--gin_file', '-f', nargs='+')
+    parser.add_argument('--gin_param', '-p', nargs='+')
+    parser.add_argument('--num_processes', '-n', type=int, default=2,
+                        help='local processes to spawn, ignored under torchrun which sets WORLD_SIZE')
+    parser.add_argument('--master_addr', default='127.0.0.1')
+    parser.add_argument('--master_port', type=int, default=29500)
+    args = parser.parse_args()
+
+    if 'WORLD_SIZE' in os.environ:
+        # one process of a torchrun launch, possibly over several machines
+        dist.init_process_group('gloo')
+        _train(args.gin_file, args.gin_param)
+    else:
+        mp.spawn(_run, nprocs=args.num_processes,
+                 args=(args.num_processes, args.master_addr, args.master_port, args.gin_file, args.gin_param))
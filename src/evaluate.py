@@ -0,0 +1,195 @@
+import math
+
+import gin
+import torch
+
+from src.agents import Reinforce
+from src.game import CircleL1, CircleL2
+
+
+@gin.configurable
+class Evaluator:
+    metrics = ('test_error', 'test_l1_error', 'test_l2_error')
+
+    def __init__(self, num_points, loss_fn, chunk_size=4096):
+        self.num_points = num_points
+        self.loss_fn = loss_fn
+        self.chunk_size = chunk_size
+
+    def distance(self, actions, targets):
+        # same arithmetic as CircleL1, the circular L2 error is its square
+        pred = torch.abs(torch.fmod(actions, self.num_points))
+        diff = torch.abs(pred - targets)
+        return torch.min(diff, self.num_points - diff)
+
+    def __call__(self, probs, actions, send_targets, recv_targets):
+        # expected error of the sender and recver for every target, where
+        #   probs are (..., batch, messages), the sender's distribution over messages
+        #   actions are (..., messages, 1), the recver's action for every message
+        #   targets are (..., batch, 1)
+        # returns (players, metrics, ...) with the mean over the batch
+        actions = actions.transpose(-1, -2)
+        num_messages = actions.size(-1)
+
+        expected = 0
+        for start in range(0, num_messages, self.chunk_size):
+            chunk_probs = probs[..., start:start + self.chunk_size]
+            chunk_actions = actions[..., start:start + self.chunk_size]
+            expected = expected + torch.stack([self.expected(chunk_probs, chunk_actions, targets)
+                                               for targets in (send_targets, recv_targets)])
+
+        # (players, metrics, ..., batch) -> (players, metrics, ...)
+        return expected.mean(-1)
+
+    def expected(self, probs, actions, targets):
+        # (metrics, ..., batch) expected errors summed over the messages in the last dim
+        l1_error = self.distance(actions, targets)
+        weighted_l1 = probs * l1_error
+        expected_l1 = weighted_l1.sum(-1)
+        expected_l2 = (weighted_l1 * l1_error).sum(-1)
+        if isinstance(self.loss_fn, CircleL1):
+            expected_error = expected_l1
+        elif isinstance(self.loss_fn, CircleL2):
+            expected_error = expected_l2
+        else:
+            expected_error = (probs * self.loss_fn(actions, targets)).sum(-1)
+        return torch.stack([expected_error, expected_l1, expected_l2])
+
+
+@gin.configurable
+class ContinuousEvaluator(Evaluator):
+    # continuous messages are evaluated on a finite set of messages
+    #   resolution=None is the dense grid of `dense_size` messages over the range of the batch's
+    #   means +- the largest std, the same for every target, with the probs from the sender's cdf
+    #   resolution=k is `k` messages per target at the quantiles (i + 0.5) / k of its gaussian,
+    #   each with prob 1 / k, so all messages are where the sender puts mass
+    def __init__(self, num_points, loss_fn, chunk_size=4096, resolution=None, dense_size=1000):
+        super().__init__(num_points, loss_fn, chunk_size)
+        self.resolution = resolution
+        self.dense_size = dense_size
+
+    def messages(self, means, stds, cdf):
+        # means and stds are (..., batch, 1) from the sender's forward_dist
+        # returns messages (..., messages) for the dense grid and (..., batch, resolution) otherwise
+        # and the probs (..., batch, messages) of sending them
+        if self.resolution is None:
+            return self.dense_messages(means, stds, cdf)
+
+        quantiles = (torch.arange(self.resolution, device=means.device) + 0.5) / self.resolution
+        normal_quantiles = math.sqrt(2) * torch.erfinv(2 * quantiles - 1)
+        messages = means + stds * normal_quantiles
+        probs = torch.full_like(messages, 1 / self.resolution)
+        return messages, probs
+
+    def dense_messages(self, means, stds, cdf):
+        min_means = means.amin(dim=-2).squeeze(-1)
+        max_means = means.amax(dim=-2).squeeze(-1)
+        max_stds = stds.amax(dim=-2).squeeze(-1)
+
+        if min_means.dim() == 0:
+            messages = torch.linspace((min_means - max_stds).item(),
+                                      (max_means + max_stds).item(), self.dense_size).to(means.device)
+        else:
+            messages = torch.stack([
+                torch.linspace(min_mean - max_std, max_mean + max_std, self.dense_size)
+                for min_mean, max_mean, max_std in zip(min_means.tolist(),
+                                                       max_means.tolist(),
+                                                       max_stds.tolist())]).to(means.device)
+        probs = cdf(messages.unsqueeze(-2))
+        probs[..., 1:] -= probs[..., :-1].clone()
+        return messages, probs
+
+    def recver_actions(self, recver, messages):
+        # the recver's action for every message, in the shape of the messages
+        if self.resolution is None:
+            action, _, _ = recver(messages.unsqueeze(-1))
+            return action
+
+        action, _, _ = recver(messages.flatten(-2).unsqueeze(-1))
+        return action.reshape(messages.shape)
+
+    def __call__(self, probs, actions, send_targets, recv_targets):
+        if self.resolution is None:
+            return super().__call__(probs, actions, send_targets, recv_targets)
+
+        # every target has its own messages, actions are (..., batch, resolution) like the probs
+        expected = torch.stack([self.expected(probs, actions, targets)
+                                for targets in (send_targets, recv_targets)])
+        return expected.mean(-1)
+
+
+def make_evaluator(sender, num_points, loss_fn):
+    if isinstance(sender, Reinforce):
+        return Evaluator(num_points, loss_fn)
+    return ContinuousEvaluator(num_points, loss_fn)
+
+
+if __name__ == '__main__':
+    import argparse
+    import tempfile
+    import time
+
+    parser = argparse.ArgumentParser(description='compare the adaptive continuous message evaluation '
+                                                 'with the dense grid for a Gaussian sender')
+    parser.add_argument('--gin_file', '-f', nargs='+')
+    parser.add_argument('--gin_param', '-p', nargs='+')
+    parser.add_argument('--loaddir', default=None,
+                        help='run dir with a models.save, otherwise train a run with the gin config')
+    parser.add_argument('--resolutions', type=int, nargs='+', default=[4, 8, 16, 32, 64])
+    parser.add_argument('--repeats', type=int, default=20)
+    args = parser.parse_args()
+
+    # registers the train configurable used by the config files
+    import train
+    from src.agents import mode
+    from src.game import Game
+    gin.parse_config_files_and_bindings(args.gin_file, args.gin_param)
+
+    Sender = gin.query_parameter('train.Sender').configurable.wrapper
+    Recver = gin.query_parameter('train.Recver').configurable.wrapper
+    vocab_size = gin.query_parameter('train.vocab_size')
+    sender = Sender(input_size=1, output_size=vocab_size, mode=mode.SENDER)
+    recver = Recver(input_size=vocab_size, output_size=1, mode=mode.RECVER)
+    if isinstance(sender, Reinforce):
+        raise SystemExit('the sender sends discrete messages, they are evaluated exactly')
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        loaddir = args.loaddir
+        if loaddir is None:
+            train.train(savedir=tmpdir)
+            loaddir = tmpdir
+        models = torch.load(f'{loaddir}/models.save')
+    sender.load_state_dict(models['sender'])
+    recver.load_state_dict(models['recver'])
+
+    test_game = Game(num_batches=1, batch_size=100, training=False)
+    try:
+        loss_fn = gin.query_parameter('train.Loss').configurable.wrapper(test_game.num_points)
+    except ValueError:
+        loss_fn = CircleL1(test_game.num_points)
+
+    results = {}
+    for resolution in [None] + args.resolutions:
+        evaluator = ContinuousEvaluator(test_game.num_points, loss_fn, resolution=resolution)
+        times = []
+        for _ in range(args.repeats):
+            start = time.perf_counter()
+            send_logs, recv_logs = train.test_agents(sender, recver, test_game, evaluator,
+                                                     vocab_size, torch.device('cpu'))
+            times.append(time.perf_counter() - start)
+        seconds = min(times)
+        results[resolution] = (send_logs, recv_logs, seconds)
+
+    dense_send, dense_recv, dense_seconds = results[None]
+    # deviations are from the dense grid, which leaves out the mass beyond one std of the batch's means
+    print(f'{"resolution":>12} {"time":>10} {"speedup":>8} '
+          + ' '.join(f'{player + "_" + metric:>18}' for player in ('send', 'recv') for metric in Evaluator.metrics[1:]))
+    for resolution, (send_logs, recv_logs, seconds) in results.items():
+        name = f'dense {evaluator.dense_size}' if resolution is None else str(resolution)
+        values = []
+        for logs, dense_logs in ((send_logs, dense_send), (recv_logs, dense_recv)):
+            for metric in Evaluator.metrics[1:]:
+                deviation = logs[metric] - dense_logs[metric]
+                values.append(f'{logs[metric]:8.3f} ({deviation:+.3f})' if resolution is not None
+                              else f'{logs[metric]:18.3f}')
+        print(f'{name:>12} {seconds * 1e3:8.3f}ms {dense_seconds / seconds:7.1f}x ' + ' '.join(values))
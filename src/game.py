@@ -7,27 +7,45 @@ from torch.nn.modules.loss import _Loss
 
 
 class CirclePointsIter:
-    def __init__(self, num_points, bias, batch_size, num_batches, device, training):
+    def __init__(self, num_points, bias, batch_size, num_batches, device, training,
+                 ensemble_size=None, generators=None, generator=None):
         self.num_points = num_points
         self.bias = bias
         self.batch_size = batch_size
         self.num_batches = num_batches
         self.device = device
         self.training = training
+        self.ensemble_size = ensemble_size
+        self.generators = generators
+        self.generator = generator
 
         self.batches = 0
 
+    def __iter__(self):
+        return self
+
     def __next__(self):
         if self.batches >= self.num_batches:
             raise StopIteration()
 
-        if self.training:
-            send_targets = self.num_points * torch.rand(size=(self.batch_size, 1),
-                                                        device=self.device)
+        if self.training and self.generators is not None:
+            # one independent stream per ensemble member
+            send_targets = self.num_points * torch.stack([
+                torch.rand(size=(self.batch_size, 1), device=self.device, generator=generator)
+                for generator in self.generators])
+        elif self.training:
+            size = (self.batch_size, 1)
+            if self.ensemble_size is not None:
+                size = (self.ensemble_size,) + size
+            send_targets = self.num_points * torch.rand(size=size,
+                                                        device=self.device,
+                                                        generator=self.generator)
         else:
             send_targets = torch.arange(0, self.num_points,
                                         step=self.num_points / self.batch_size,
                                         device=self.device).unsqueeze(1)
+            if self.ensemble_size is not None:
+                send_targets = send_targets.expand(self.ensemble_size, -1, -1)
 
         recv_targets = (send_targets + self.bias) % self.num_points
 
@@ -38,17 +56,66 @@ class CirclePointsIter:
 
 @gin.configurable
 class Game(DataLoader):
-    def __init__(self, num_points, bias, batch_size, num_batches, device='cpu', training=True):
+    def __init__(self, num_points, bias, batch_size, num_batches, device='cpu', training=True,
+                 ensemble_size=None, generators=None, generator=None, pregenerate=False):
         self.batch_size = batch_size
         self.num_points = num_points
+        if isinstance(bias, (list, tuple)):
+            # one bias per ensemble member, broadcast over (members, batch, 1)
+            bias = torch.tensor(bias, dtype=torch.float, device=device).view(-1, 1, 1)
         self.bias = bias
         self.num_batches = num_batches
         self.device = device
         self.training = training
+        self.ensemble_size = ensemble_size
+        # per-member streams of ensembles, or the stream of a single run
+        self.generators = generators
+        self.generator = generator
+        # sample a whole epoch at once into buffers that are reused every epoch
+        self.pregenerate = pregenerate
+
+        self._send_buffer = None
+        self._recv_buffer = None
+        self._test_batches = None
 
     def __iter__(self):
+        if not self.training:
+            # the test points are a fixed grid so only compute them once
+            if self._test_batches is None:
+                self._test_batches = list(self._points_iter())
+            return iter(self._test_batches)
+        elif self.pregenerate:
+            return self._epoch_iter()
+        else:
+            return self._points_iter()
+
+    def __len__(self):
+        return self.num_batches
+
+    def _points_iter(self):
         return CirclePointsIter(self.num_points, self.bias, self.batch_size,
-                                self.num_batches, self.device, training=self.training)
+                                self.num_batches, self.device, training=self.training,
+                                ensemble_size=self.ensemble_size, generators=self.generators,
+                                generator=self.generator)
+
+    def _epoch_iter(self):
+        if self._send_buffer is None:
+            size = (self.num_batches, self.batch_size, 1)
+            if self.ensemble_size is not None:
+                size = size[:1] + (self.ensemble_size,) + size[1:]
+            self._send_buffer = torch.empty(size, device=self.device)
+            self._recv_buffer = torch.empty(size, device=self.device)
+
+        if self.generators is not None:
+            for member, generator in enumerate(self.generators):
+                self._send_buffer[:, member].uniform_(0, self.num_points, generator=generator)
+        else:
+            self._send_buffer.uniform_(0, self.num_points, generator=self.generator)
+
+        torch.add(self._send_buffer, self.bias, out=self._recv_buffer)
+        self._recv_buffer.remainder_(self.num_points)
+
+        return zip(self._send_buffer, self._recv_buffer)
 
 
 @gin.configurable
@@ -0,0 +1,150 @@
+import hashlib
+import json
+import os
+
+import numpy as np
+import torch
+
+
+# the log files of a run, in the order read_logs prefers them
+LOG_FILES = ('logs.parquet', 'logs.npz', 'logs.jsonl', 'logs.json')
+
+
+class MetricsAccumulator:
+    # running sums of tensor logs that stay on device until `mean` is called
+    def __init__(self):
+        self.sums = {}
+        self.count = 0
+
+    def add(self, logs):
+        for key, value in logs.items():
+            if key in self.sums:
+                self.sums[key].add_(value)
+            else:
+                self.sums[key] = value.detach().clone()
+        self.count += 1
+
+    def mean(self):
+        # a single host sync, values are floats or one float per ensemble member
+        keys = list(self.sums)
+        if not keys:
+            return {}
+        values = (torch.stack([self.sums[key] for key in keys]) / self.count).tolist()
+        return dict(zip(keys, values))
+
+    def reset(self):
+        self.sums = {}
+        self.count = 0
+
+
+def _flatten(records):
+    # [{'epoch': 0, 'sender': {...}, 'recver': {...}}, ...] -> {'epoch': [...], 'sender.loss': [...], ...}
+    names = []
+    for record in records:
+        for key, value in record.items():
+            for name in ([f'{key}.{k}' for k in value] if isinstance(value, dict) else [key]):
+                if name not in names:
+                    names.append(name)
+
+    columns = {name: [] for name in names}
+    for record in records:
+        for name in names:
+            key, _, metric = name.partition('.')
+            value = record.get(key, {}).get(metric) if metric else record.get(key)
+            columns[name].append(float('nan') if value is None else value)
+
+    return columns
+
+
+def _write_columns(path, columns):
+    try:
+        import pyarrow
+        import pyarrow.parquet
+    except ImportError:
+        np.savez(f'{path}.npz', **{name: np.asarray(values) for name, values in columns.items()})
+    else:
+        pyarrow.parquet.write_table(pyarrow.table(columns), f'{path}.parquet')
+
+
+class MetricsWriter:
+    # appends one compact json line per epoch to logs.jsonl, flushed after every epoch
+    # so a killed run still has all its finished epochs, and on close writes the
+    # logs as flat sender.*/recver.* columns to logs.parquet (logs.npz without pyarrow)
+    def __init__(self, run_dir, fsync=False):
+        self.run_dir = run_dir
+        self.fsync = fsync
+        self.records = []
+        self.file = open(f'{run_dir}/logs.jsonl', 'w')
+
+    def write(self, epoch, send_logs, recv_logs):
+        record = {'epoch': epoch, 'sender': send_logs, 'recver': recv_logs}
+        self.file.write(json.dumps(record, separators=(',', ':')) + '\n')
+        self.flush()
+        self.records.append(record)
+
+    def flush(self):
+        self.file.flush()
+        if self.fsync:
+            os.fsync(self.file.fileno())
+
+    def close(self):
+        self.file.close()
+        _write_columns(f'{self.run_dir}/logs', _flatten(self.records))
+
+
+def read_logs(run_dir):
+    # flat columns of a run's logs, from the columnar file if the run finished,
+    # otherwise from logs.jsonl or the logs.json of older runs, None without logs
+    run_dir = str(run_dir)
+    if os.path.exists(f'{run_dir}/logs.parquet'):
+        import pyarrow.parquet
+        return pyarrow.parquet.read_table(f'{run_dir}/logs.parquet').to_pydict()
+
+    if os.path.exists(f'{run_dir}/logs.npz'):
+        with np.load(f'{run_dir}/logs.npz') as columns:
+            return {name: columns[name] for name in columns.files}
+
+    if os.path.exists(f'{run_dir}/logs.jsonl'):
+        with open(f'{run_dir}/logs.jsonl') as f:
+            lines = f.read().split('\n')
+        # the last line is incomplete if the run was killed while writing it
+        return _flatten([json.loads(line) for line in lines[:-1]])
+
+    if os.path.exists(f'{run_dir}/logs.json'):
+        with open(f'{run_dir}/logs.json') as f:
+            return _flatten(json.load(f))
+
+    return None
+
+
+def player_logs(logs, player):
+    # the sender.*/recver.* columns of a dataframe of read_logs without the prefix
+    prefix = f'{player}.'
+    columns = [column for column in logs.columns if column.startswith(prefix)]
+    return logs[columns].rename(columns=lambda column: column[len(prefix):])
+
+
+def parse_bindings(config_str):
+    # the bindings of an operative config as strings
+    bindings = {}
+    for line in config_str.splitlines():
+        name, sep, value = line.partition(' = ')
+        if sep and not line.startswith('#'):
+            bindings[name.strip()] = value.strip()
+    return bindings
+
+
+def config_bindings(config_file):
+    # the bindings of a config.gin as strings
+    with open(config_file) as f:
+        return parse_bindings(f.read())
+
+
+def files_signature(root, paths):
+    # hash of the size and mtime of the paths that exist, named relative to root
+    stats = []
+    for path in paths:
+        if path.exists():
+            stat = path.stat()
+            stats.append(f'{path.relative_to(root)}:{stat.st_size}:{stat.st_mtime_ns}')
+    return hashlib.sha1('\n'.join(stats).encode()).hexdigest()
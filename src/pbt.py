@@ -0,0 +1,178 @@
+import json
+import math
+import random
+
+import gin
+import torch
+
+
+def _members(values, param):
+    # per-member values shaped to broadcast over a stacked ensemble parameter
+    return values.to(param.device).reshape(-1, *[1] * (param.dim() - 1))
+
+
+class MemberLR:
+    # optimizer wrapper with one learning rate per ensemble member
+    # the optimizer steps with lr=1 and every member's update is scaled by its lr,
+    # which is the same as Adam with that lr since Adam's update is linear in lr
+    def __init__(self, optimizer, lrs):
+        self.optimizer = optimizer
+        self.lrs = lrs
+        for group in self.optimizer.param_groups:
+            group['lr'] = 1.
+        self.params = [param for group in self.optimizer.param_groups for param in group['params']]
+
+    def zero_grad(self):
+        self.optimizer.zero_grad()
+
+    def step(self):
+        before = [param.detach().clone() for param in self.params]
+        self.optimizer.step()
+        with torch.no_grad():
+            for param, old in zip(self.params, before):
+                param.copy_(torch.lerp(old, param, _members(self.lrs, param)))
+
+    def state_dict(self):
+        return self.optimizer.state_dict()
+
+    def load_state_dict(self, state):
+        self.optimizer.load_state_dict(state)
+        for group in self.optimizer.param_groups:
+            group['lr'] = 1.
+
+    def copy_member(self, src, dst):
+        # Adam's moments of member dst become those of member src
+        for param in self.params:
+            for value in self.optimizer.state.get(param, {}).values():
+                if torch.is_tensor(value) and value.dim() > 0 and value.size(0) == len(self.lrs):
+                    value[dst] = value[src]
+
+
+@gin.configurable
+class PopulationBasedTraining:
+    # population based training of an ensemble (train.ensemble_seeds is the population)
+    # every member starts with its lrs and ent_regs sampled log-uniformly from the given ranges,
+    # like the -search.gin priors (None keeps the agent's configured value), and every
+    # `ready_epochs` the members with the worst test L1 error over the last `window` epochs
+    # copy the weights, Adam state, baseline and hyperparameters of a random member from the
+    # best `fraction` and then multiply each hyperparameter by a random factor from `perturb`
+    # all members share one architecture, so hidden sizes can't be searched
+    def __init__(self, sender_lr=(1e-4, 1e-2), recver_lr=(1e-4, 1e-2),
+                 sender_ent_reg=(1e-4, 1.), recver_ent_reg=(1e-4, 1.),
+                 ready_epochs=5, window=3, fraction=0.25, perturb=(0.8, 1.2), seed=0):
+        self.ranges = {'sender_lr': sender_lr, 'recver_lr': recver_lr,
+                       'sender_ent_reg': sender_ent_reg, 'recver_ent_reg': recver_ent_reg}
+        self.ready_epochs = ready_epochs
+        self.window = window
+        self.fraction = fraction
+        self.perturb = perturb
+        self.rng = random.Random(seed)
+
+    def setup(self, sender, recver, send_opt, recv_opt, savedirs, num_epochs):
+        # returns the optimizers to train with
+        self.num_epochs = num_epochs
+        self.agents = {'sender': sender, 'recver': recver}
+        self.size = sender.ensemble_size
+        if self.size is None:
+            raise ValueError('population based training needs train.ensemble_seeds for the population')
+
+        self.hyperparams = {}
+        for name, value_range in self.ranges.items():
+            agent_name, hyperparam = name.split('_', 1)
+            default = getattr(self.agents[agent_name], hyperparam, None)
+            # agents without an entropy regularizer have nothing to search
+            if default is None:
+                continue
+            if value_range is None:
+                values = [default] * self.size
+            else:
+                low, high = value_range
+                values = [math.exp(self.rng.uniform(math.log(low), math.log(high))) for _ in range(self.size)]
+            self.hyperparams[name] = torch.tensor(values)
+
+        self.optimizers = {'sender': MemberLR(send_opt, self.hyperparams['sender_lr']),
+                           'recver': MemberLR(recv_opt, self.hyperparams['recver_lr'])}
+        self._set_ent_regs()
+
+        self.errors = []
+        self.schedule = [[] for _ in range(self.size)]
+        self.schedule_files = [open(f'{savedir}/hyperparams.jsonl', 'w') for savedir in savedirs]
+        self._log_schedule(0, [None] * self.size)
+
+        return self.optimizers['sender'], self.optimizers['recver']
+
+    def _set_ent_regs(self):
+        # a tensor ent_reg weights every member's entropy by its own value
+        for agent_name, agent in self.agents.items():
+            if f'{agent_name}_ent_reg' in self.hyperparams:
+                device = next(agent.parameters()).device
+                agent.ent_reg = self.hyperparams[f'{agent_name}_ent_reg'].to(device)
+
+    def _log_schedule(self, epoch, copied_from):
+        for index in range(self.size):
+            record = {'epoch': epoch, 'copied_from': copied_from[index]}
+            record.update({name: values[index].item() for name, values in self.hyperparams.items()})
+            self.schedule[index].append(record)
+        self._write_schedule(start=-1)
+
+    def _write_schedule(self, start=0):
+        for records, schedule_file in zip(self.schedule, self.schedule_files):
+            for record in records[start:]:
+                schedule_file.write(json.dumps(record) + '\n')
+            schedule_file.flush()
+
+    def step(self, epoch, send_logs, recv_logs):
+        self.errors.append([send + recv for send, recv in zip(send_logs['test_l1_error'],
+                                                               recv_logs['test_l1_error'])])
+        # no exploit after the last epoch, the members are saved with the weights they trained
+        if (epoch + 1) % self.ready_epochs != 0 or epoch + 1 >= self.num_epochs:
+            return
+
+        recent = self.errors[-self.window:]
+        scores = [sum(errors) / len(recent) for errors in zip(*recent)]
+        ranking = sorted(range(self.size), key=lambda index: scores[index])
+        num_exploit = max(1, int(self.size * self.fraction))
+        best, worst = ranking[:num_exploit], ranking[-num_exploit:]
+
+        copied_from = [None] * self.size
+        for dst in worst:
+            src = self.rng.choice(best)
+            copied_from[dst] = src
+            self._copy_member(src, dst)
+            for values in self.hyperparams.values():
+                values[dst] = values[src] * self.rng.choice(self.perturb)
+
+        self._set_ent_regs()
+        self._log_schedule(epoch + 1, copied_from)
+
+    def _copy_member(self, src, dst):
+        for agent_name, agent in self.agents.items():
+            agent.load_member_state_dict(dst, agent.member_state_dict(src))
+            self.optimizers[agent_name].copy_member(src, dst)
+            if hasattr(agent, 'baseline'):
+                baseline = agent.baseline.clone()
+                baseline[dst] = baseline[src]
+                agent.baseline = baseline
+
+    def state_dict(self):
+        return {'hyperparams': {name: values.clone() for name, values in self.hyperparams.items()},
+                'errors': self.errors,
+                'schedule': self.schedule,
+                'rng': self.rng.getstate()}
+
+    def load_state_dict(self, state):
+        # in place, the optimizers hold the lr tensors
+        for name, values in state['hyperparams'].items():
+            self.hyperparams[name].copy_(values)
+        self._set_ent_regs()
+        self.errors = state['errors']
+        self.schedule = state['schedule']
+        self.rng.setstate(state['rng'])
+        for schedule_file in self.schedule_files:
+            schedule_file.seek(0)
+            schedule_file.truncate()
+        self._write_schedule()
+
+    def close(self):
+        for schedule_file in self.schedule_files:
+            schedule_file.close()
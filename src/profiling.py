@@ -0,0 +1,59 @@
+import time
+
+import torch
+
+
+class PhaseTimer:
+    # wall time per phase, each lap adds the time since the previous lap to a phase
+    def __init__(self, enabled=False, device=None):
+        self.enabled = enabled
+        # cuda kernels are asynchronous so sync before reading the clock
+        self.sync = enabled and device is not None and torch.device(device).type == 'cuda'
+        self.totals = {}
+        self.last = None
+
+    def start(self):
+        if self.enabled:
+            if self.sync:
+                torch.cuda.synchronize()
+            self.last = time.perf_counter()
+
+    def lap(self, phase):
+        if not self.enabled:
+            return
+        if self.sync:
+            torch.cuda.synchronize()
+        now = time.perf_counter()
+        self.totals[phase] = self.totals.get(phase, 0.) + now - self.last
+        self.last = now
+
+    def pop(self):
+        totals = self.totals
+        self.totals = {}
+        return totals
+
+
+class EpochProfiler:
+    # runs torch.profiler over epochs [start, end) and writes a chrome trace
+    def __init__(self, epochs, trace_path, device=None):
+        self.start_epoch, self.end_epoch = epochs
+        self.trace_path = trace_path
+        activities = [torch.profiler.ProfilerActivity.CPU]
+        if device is not None and torch.device(device).type == 'cuda':
+            activities.append(torch.profiler.ProfilerActivity.CUDA)
+        self.profiler = torch.profiler.profile(activities=activities)
+        self.running = False
+
+    def step(self, epoch):
+        if epoch == self.start_epoch:
+            self.profiler.__enter__()
+            self.running = True
+        elif epoch == self.end_epoch:
+            self.stop()
+
+    def stop(self):
+        if self.running:
+            self.profiler.__exit__(None, None, None)
+            self.profiler.export_chrome_trace(self.trace_path)
+            self.running = False
+            print(f'wrote profiler trace to {self.trace_path}')
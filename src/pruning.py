@@ -0,0 +1,96 @@
+import fcntl
+import json
+import math
+import os
+
+
+def _mean(value):
+    if isinstance(value, list):
+        return sum(value) / len(value)
+    return value
+
+
+class TrialPruner:
+    # epoch callback for train() that stops a run when
+    #   - its test L1 error is nan, or both players are above `divergence_threshold`
+    #     from `divergence_start` on (gen_results discards those runs anyway)
+    #   - it falls behind the other trials at a successive halving rung: at epochs
+    #     min_epochs * reduction_factor**k a run only continues if its error is in the
+    #     best 1 / reduction_factor of all runs that reached that rung, like ASHA
+    # rungs are shared between trial processes through a locked json file
+    def __init__(self, trial_id, rung_file=None, num_epochs=None,
+                 min_epochs=5, reduction_factor=2, window=3,
+                 divergence_threshold=None, divergence_start=10):
+        self.trial_id = trial_id
+        self.run_key = 'all'
+        self.rung_file = rung_file
+        self.reduction_factor = reduction_factor
+        self.window = window
+        self.divergence_threshold = divergence_threshold
+        self.divergence_start = divergence_start
+
+        self.rungs = []
+        if rung_file is not None and num_epochs is not None:
+            rung = min_epochs
+            while rung < num_epochs:
+                self.rungs.append(rung)
+                rung *= reduction_factor
+
+        self.errors = []
+        self.pruned = False
+        self.reason = None
+
+    def start_run(self, run_key):
+        # a trial that trains its seeds one at a time only competes with the same seed of other trials
+        self.run_key = str(run_key)
+        self.errors = []
+
+    def __call__(self, epoch, send_logs, recv_logs):
+        send_error = _mean(send_logs['test_l1_error'])
+        recv_error = _mean(recv_logs['test_l1_error'])
+        self.errors.append(send_error + recv_error)
+
+        if math.isnan(send_error + recv_error):
+            return self.prune(f'nan error at epoch {epoch}')
+
+        if (self.divergence_threshold is not None and epoch >= self.divergence_start
+                and send_error > self.divergence_threshold
+                and recv_error > self.divergence_threshold):
+            return self.prune(f'diverged at epoch {epoch}: L1 errors {send_error:2.2f} {recv_error:2.2f}')
+
+        if epoch + 1 in self.rungs:
+            recent = self.errors[-self.window:]
+            rung_error = sum(recent) / len(recent)
+            if not self.promotable(epoch + 1, rung_error):
+                return self.prune(f'not in the best 1/{self.reduction_factor} at epoch {epoch}: '
+                                  f'L1 error {rung_error:2.2f}')
+
+        return False
+
+    def prune(self, reason):
+        self.pruned = True
+        self.reason = reason
+        print(f'pruning {self.trial_id} run {self.run_key}: {reason}')
+        return True
+
+    def promotable(self, rung, error):
+        with open(f'{self.rung_file}.lock', 'w') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            if os.path.exists(self.rung_file):
+                with open(self.rung_file) as f:
+                    rungs = json.load(f)
+            else:
+                rungs = {}
+
+            rung_errors = rungs.setdefault(str(rung), {}).setdefault(self.run_key, {})
+            rung_errors[self.trial_id] = error
+
+            tmp_file = f'{self.rung_file}.tmp'
+            with open(tmp_file, 'w') as f:
+                json.dump(rungs, f, indent=2)
+            os.replace(tmp_file, self.rung_file)
+
+        # the best run always continues, even if it is alone at this rung
+        num_promoted = max(len(rung_errors) // self.reduction_factor, 1)
+        threshold = sorted(rung_errors.values())[num_promoted - 1]
+        return error <= threshold
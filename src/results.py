@@ -0,0 +1,208 @@
+import ast
+import json
+import os
+from pathlib import Path
+import shutil
+
+import numpy as np
+import pandas as pd
+
+from src.metrics import LOG_FILES, config_bindings, files_signature, read_logs
+
+
+def config_params(config_file):
+    # the bindings of a config.gin, with python literals parsed and everything else as strings
+    params = {}
+    for name, value in config_bindings(config_file).items():
+        try:
+            value = ast.literal_eval(value)
+        except (ValueError, SyntaxError):
+            pass
+        params[name] = value
+    return params
+
+
+def _signature(run_dir):
+    return files_signature(run_dir, [run_dir / name for name in LOG_FILES + ('config.gin',)])
+
+
+def _find_runs(results_path):
+    # every dir with a config.gin and logs, as paths relative to the results dir
+    runs = []
+    for config_file in sorted(results_path.rglob('config.gin')):
+        run_dir = config_file.parent
+        if '.results_cache' not in run_dir.parts and any((run_dir / name).exists() for name in LOG_FILES):
+            runs.append(run_dir.relative_to(results_path))
+    return runs
+
+
+def _index_row(results_path, run, params):
+    # columns of the run index, the config bindings keep their gin names
+    pruned = (results_path / run.parent / 'pruned').exists()
+    seed = int(run.name) if run.name.isdigit() else run.name
+    sender = params.get('train.Sender')
+    recver = params.get('train.Recver')
+    return {'run': str(run),
+            'trial': str(run.parent),
+            'seed': seed,
+            'bias': params.get('Game.bias'),
+            'sender': sender.lstrip('@') if isinstance(sender, str) else sender,
+            'recver': recver.lstrip('@') if isinstance(recver, str) else recver,
+            'pruned': pruned,
+            **params}
+
+
+class Results:
+    # a results dir as a lazy table: an index of the runs and their config, with every
+    # metric kept as one memory-mapped array over all runs in `{results_dir}/.results_cache`
+    # the cache is built from the runs' logs the first time and then only the runs whose
+    # files changed are read again, metrics are only read for the selected runs
+    def __init__(self, results_dir, index=None, columns=None):
+        self.results_path = Path(results_dir)
+        self.cache_path = self.results_path / '.results_cache'
+        if index is None:
+            index, columns = self._load()
+        self.index = index
+        self._columns = columns
+
+    def _load(self):
+        runs = _find_runs(self.results_path)
+        signatures = {str(run): _signature(self.results_path / run) for run in runs}
+
+        cached = {}
+        old_columns = {}
+        index_file = self.cache_path / 'index.json'
+        if index_file.exists():
+            with open(index_file) as f:
+                cache = json.load(f)
+            cached = {row['run']: row for row in cache['runs']}
+            old_columns = self._memmaps(cache['columns'])
+
+        if cached.keys() != signatures.keys() or any(cached[run]['signature'] != signature
+                                                     for run, signature in signatures.items()):
+            cached, old_columns = self._update(runs, signatures, cached, old_columns)
+
+        index = pd.DataFrame([{**row['index'], 'offset': row['offset'], 'length': row['length']}
+                              for row in (cached[str(run)] for run in runs)])
+        return index, old_columns
+
+    def _memmaps(self, names):
+        return {name: np.load(self.cache_path / f'{name}.npy', mmap_mode='r') for name in names}
+
+    def _update(self, runs, signatures, cached, old_columns):
+        # logs of the new and changed runs, the other runs are copied from the old arrays
+        logs = {}
+        for run in runs:
+            key = str(run)
+            if key not in cached or cached[key]['signature'] != signatures[key]:
+                columns = read_logs(self.results_path / run) or {}
+                logs[key] = {name: np.asarray(values, dtype=np.float64) for name, values in columns.items()}
+
+        names = set(old_columns)
+        for columns in logs.values():
+            names.update(columns)
+        names = sorted(names)
+
+        rows = {}
+        offset = 0
+        for run in runs:
+            key = str(run)
+            if key in logs:
+                length = max((len(values) for values in logs[key].values()), default=0)
+                params = config_params(self.results_path / run / 'config.gin')
+                index_row = _index_row(self.results_path, run, params)
+            else:
+                length = cached[key]['length']
+                index_row = cached[key]['index']
+            rows[key] = {'run': key, 'signature': signatures[key], 'index': index_row,
+                         'offset': offset, 'length': length}
+            offset += length
+
+        # the new arrays are written next to the old ones and then replace them
+        tmp_path = self.cache_path.with_name('.results_cache.tmp')
+        shutil.rmtree(tmp_path, ignore_errors=True)
+        tmp_path.mkdir(parents=True)
+        for name in names:
+            array = np.lib.format.open_memmap(tmp_path / f'{name}.npy', mode='w+',
+                                              dtype=np.float64, shape=(offset,))
+            for key, row in rows.items():
+                start, end = row['offset'], row['offset'] + row['length']
+                if key in logs:
+                    values = logs[key].get(name)
+                else:
+                    old = cached[key]['offset']
+                    values = old_columns[name][old:old + row['length']] if name in old_columns else None
+                array[start:end] = np.nan if values is None else values
+            array.flush()
+            del array
+
+        with open(tmp_path / 'index.json', 'w') as f:
+            json.dump({'columns': names, 'runs': list(rows.values())}, f, default=str)
+        old_columns.clear()
+        shutil.rmtree(self.cache_path, ignore_errors=True)
+        os.replace(tmp_path, self.cache_path)
+
+        return rows, self._memmaps(names)
+
+    @property
+    def columns(self):
+        return list(self._columns)
+
+    def __len__(self):
+        return len(self.index)
+
+    def where(self, mask=None, **params):
+        # the runs where mask is true and every param (an index column) has the given value,
+        # `sender='Reinforce'`, `bias=[0, 3]` or `**{'Reinforce.lr': 1e-3}`
+        selected = pd.Series(True, index=self.index.index) if mask is None else mask
+        for name, value in params.items():
+            values = value if isinstance(value, (list, tuple, set)) else [value]
+            selected &= self.index[name].isin(values)
+        return Results(self.results_path, self.index[selected], self._columns)
+
+    def values(self, column, run):
+        # the column of one run, a view of the memory map
+        row = self.index[self.index['run'] == str(run)].iloc[0]
+        return self._columns[column][row['offset']:row['offset'] + row['length']]
+
+    def _positions(self, last_epochs=None):
+        offsets = self.index['offset'].to_numpy()
+        lengths = self.index['length'].to_numpy()
+        if last_epochs is not None:
+            offsets = offsets + np.maximum(lengths - last_epochs, 0)
+            lengths = np.minimum(lengths, last_epochs)
+        starts = np.repeat(offsets - np.cumsum(lengths) + lengths, lengths)
+        return np.arange(lengths.sum()) + starts, lengths
+
+    def frame(self, columns=None, params=('trial', 'seed')):
+        # long table of the selected runs with one row per epoch, only reads those columns
+        columns = self.columns if columns is None else list(columns)
+        positions, lengths = self._positions()
+        frame = pd.DataFrame({param: np.repeat(self.index[param].to_numpy(), lengths) for param in params})
+        for column in columns:
+            frame[column] = self._columns[column][positions]
+        return frame
+
+    def last_epochs_mean(self, columns, last_epochs=10):
+        # mean of every column over each run's last epochs, one row per run
+        positions, lengths = self._positions(last_epochs)
+        starts = np.cumsum(lengths) - lengths
+        logged = lengths > 0
+        means = {}
+        for column in columns:
+            sums = np.full(len(lengths), np.nan)
+            if logged.any():
+                sums[logged] = np.add.reduceat(self._columns[column][positions], starts[logged])
+            means[column] = sums / np.maximum(lengths, 1)
+        return pd.DataFrame(means, index=self.index.index)
+
+    def score(self, metric='test_l1_error', last_epochs=10):
+        # sender + recver metric over the last epochs of every run, like gen_results.py
+        means = self.last_epochs_mean([f'sender.{metric}', f'recver.{metric}'], last_epochs)
+        return means[f'sender.{metric}'] + means[f'recver.{metric}']
+
+    def groupby(self, by=('bias', 'sender', 'seed'), metric='test_l1_error', last_epochs=10):
+        # scores of the selected runs aggregated over groups of index columns
+        table = self.index[list(by)].copy()
+        table['score'] = self.score(metric, last_epochs)
+        return table.groupby(list(by), dropna=False)['score'].agg(['mean', 'std', 'min', 'count'])
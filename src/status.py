@@ -0,0 +1,195 @@
+import argparse
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import json
+import os
+from pathlib import Path
+import socket
+import threading
+import time
+
+
+# the train and test metrics in status.json, per agent
+STATUS_METRICS = ('error', 'loss', 'test_error', 'test_l1_error')
+
+
+def _member(logs, index):
+    if index is None:
+        return logs
+    return {key: value[index] if isinstance(value, list) else value for key, value in logs.items()}
+
+
+class LiveStatus:
+    # status.json in every run dir with the epoch, steps/s, latest errors and ETA of the run
+    # train only updates counters and the latest logs in memory, a background thread
+    # rewrites the files atomically every `interval` seconds so training never waits on I/O
+    def __init__(self, run_dirs, num_epochs, num_batches, interval=10., ensemble=False):
+        self.run_dirs = list(run_dirs)
+        self.num_epochs = num_epochs
+        self.num_batches = num_batches
+        self.interval = interval
+        self.ensemble = ensemble
+        self.host = socket.gethostname()
+
+        self.state = 'running'
+        self.epoch = 0
+        self.steps = 0
+        self.start_steps = None
+        self.start_time = None
+        self.send_logs = {}
+        self.recv_logs = {}
+
+        self.lock = threading.Lock()
+        self.done = threading.Event()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def start(self, epoch):
+        # steps/s and the ETA only count the steps of this process, not a resumed checkpoint's
+        with self.lock:
+            self.epoch = epoch
+            self.steps = self.start_steps = epoch * self.num_batches
+            self.start_time = time.perf_counter()
+
+    def step(self):
+        self.steps += 1
+
+    def epoch_end(self, epoch, send_logs, recv_logs):
+        with self.lock:
+            self.epoch = epoch + 1
+            self.send_logs = send_logs
+            self.recv_logs = recv_logs
+
+    def close(self, state='finished'):
+        with self.lock:
+            self.state = state
+        self.done.set()
+        self.thread.join()
+
+    def _run(self):
+        while not self.done.wait(self.interval):
+            self._write()
+        self._write()
+
+    def _write(self):
+        with self.lock:
+            status = self._status()
+            send_logs, recv_logs = self.send_logs, self.recv_logs
+
+        for index, run_dir in enumerate(self.run_dirs):
+            member = index if self.ensemble else None
+            member_send, member_recv = _member(send_logs, member), _member(recv_logs, member)
+            run_status = dict(status,
+                              sender={key: member_send[key] for key in STATUS_METRICS if key in member_send},
+                              recver={key: member_recv[key] for key in STATUS_METRICS if key in member_recv})
+            path = os.path.join(run_dir, 'status.json')
+            with open(f'{path}.tmp', 'w') as f:
+                json.dump(run_status, f)
+            os.replace(f'{path}.tmp', path)
+
+    def _status(self):
+        steps = self.steps
+        total_steps = self.num_epochs * self.num_batches
+        elapsed = time.perf_counter() - self.start_time if self.start_time is not None else 0.
+        steps_per_s = (steps - self.start_steps) / elapsed if elapsed > 0 else 0.
+        if self.state != 'running':
+            eta = 0.
+        elif steps_per_s > 0:
+            eta = (total_steps - steps) / steps_per_s
+        else:
+            eta = None
+        return {'state': self.state,
+                'epoch': self.epoch,
+                'num_epochs': self.num_epochs,
+                'steps': steps,
+                'total_steps': total_steps,
+                'steps_per_s': steps_per_s,
+                'eta_s': eta,
+                'updated': time.time(),
+                'host': self.host,
+                'pid': os.getpid()}
+
+
+def read_statuses(results_dir):
+    # {run dir relative to results_dir: status} of every status.json under results_dir
+    results_path = Path(results_dir)
+    statuses = {}
+    for path in sorted(results_path.rglob('status.json')):
+        try:
+            with open(path) as f:
+                statuses[str(path.parent.relative_to(results_path))] = json.load(f)
+        except (OSError, ValueError):
+            # removed between the glob and the read
+            continue
+    return statuses
+
+
+def _label(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"')
+
+
+def prometheus_text(statuses):
+    # prometheus text exposition of the statuses, one series per run (and agent)
+    gauges = {
+        'emergent_run_running': ('1 while the run trains', lambda s: float(s['state'] == 'running')),
+        'emergent_run_epoch': ('finished epochs', lambda s: s['epoch']),
+        'emergent_run_num_epochs': ('epochs the run trains for', lambda s: s['num_epochs']),
+        'emergent_run_steps_per_second': ('training steps per second', lambda s: s['steps_per_s']),
+        'emergent_run_eta_seconds': ('estimated seconds left', lambda s: s['eta_s']),
+        'emergent_run_updated_timestamp_seconds': ('last status update', lambda s: s['updated']),
+    }
+    lines = []
+    for name, (description, value) in gauges.items():
+        lines += [f'# HELP {name} {description}', f'# TYPE {name} gauge']
+        for run, status in statuses.items():
+            if value(status) is not None:
+                lines.append(f'{name}{{run="{_label(run)}"}} {value(status)}')
+
+    for metric in STATUS_METRICS:
+        name = f'emergent_run_{metric}'
+        lines += [f'# HELP {name} latest epoch {metric}', f'# TYPE {name} gauge']
+        for run, status in statuses.items():
+            for agent in ('sender', 'recver'):
+                if metric in status.get(agent, {}):
+                    lines.append(f'{name}{{run="{_label(run)}",agent="{agent}"}} {status[agent][metric]}')
+
+    return '\n'.join(lines) + '\n'
+
+
+def serve(results_dir, port, host='127.0.0.1'):
+    # /metrics reads the status files of every run under results_dir on each scrape
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split('?')[0] != '/metrics':
+                self.send_error(404)
+                return
+            body = prometheus_text(read_statuses(results_dir)).encode()
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/plain; version=0.0.4')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer((host, port), Handler)
+    print(f'serving the status of the runs in {results_dir} on http://{host}:{port}/metrics')
+    server.serve_forever()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='live status of the runs under a results dir')
+    parser.add_argument('results_dir')
+    parser.add_argument('--serve', type=int, default=None, metavar='PORT',
+                        help='serve the status in the prometheus text format on this port')
+    parser.add_argument('--host', default='127.0.0.1')
+    args = parser.parse_args()
+
+    if args.serve is not None:
+        serve(args.results_dir, args.serve, args.host)
+    else:
+        for run, status in read_statuses(args.results_dir).items():
+            eta = '-' if status['eta_s'] is None else f'{status["eta_s"]:.0f}s'
+            l1 = sum(status[agent].get('test_l1_error', float('nan')) for agent in ('sender', 'recver'))
+            print(f'{run:50} {status["state"]:9} epoch {status["epoch"]:>4}/{status["num_epochs"]:<4} '
+                  f'{status["steps_per_s"]:8.1f} steps/s  eta {eta:>7}  l1 {l1:6.2f}')
@@ -1,30 +1,149 @@
 import argparse
 import json
 import os
-import random
 
 import gin
 import numpy as np
 import torch
 import torch.nn as nn
-from torch.optim import Adam
 
 from src.agents import mode, Reinforce
-from src.game import Game, CircleL1, CircleL2
+from src.checkpoint import (Checkpointer, buffers_state, load_buffers_state, rng_state, load_rng_state,
+                            checkpoint_bindings, check_bindings)
+from src import distributed
+from src.compiled import step_losses, compile_step_losses, compiled_step, make_optimizer
+from src.evaluate import Evaluator, make_evaluator
+from src.game import Game, CircleL1
+from src.metrics import MetricsAccumulator, MetricsWriter
+from src.pbt import PopulationBasedTraining
+from src.profiling import PhaseTimer, EpochProfiler
+from src.status import LiveStatus
 
 
-def _add_dicts(a, b):
-    result = dict(a)
-    for k, v in b.items():
-        result[k] = result.get(k, 0) + v
-    return result
+def _member(d, index):
+    return {k: v[index] if isinstance(v, list) else v for k, v in d.items()}
 
 
-def _div_dict(d, n):
-    result = dict(d)
-    for k in result:
-        result[k] /= n
-    return result
+def _mean(value):
+    if isinstance(value, list):
+        return sum(value) / len(value)
+    return value
+
+
+def _map(fn, value):
+    if isinstance(value, list):
+        return [fn(v) for v in value]
+    return fn(value)
+
+
+def _first(x, ensemble_size):
+    # first element of the batch, per member for ensembles
+    if ensemble_size is None:
+        return x.reshape(-1)[0]
+    return x.reshape(ensemble_size, -1)[:, 0]
+
+
+def _build_ensemble(Sender, Recver, vocab_size, generators):
+    sender = Sender(input_size=1,
+                    output_size=vocab_size,
+                    mode=mode.SENDER,
+                    ensemble_size=len(generators))
+    recver = Recver(input_size=vocab_size,
+                    output_size=1,
+                    mode=mode.RECVER,
+                    ensemble_size=len(generators))
+
+    # initialize every member exactly as a single run with that seed would
+    for index, generator in enumerate(generators):
+        member_sender = Sender(input_size=1,
+                               output_size=vocab_size,
+                               mode=mode.SENDER)
+        member_recver = Recver(input_size=vocab_size,
+                               output_size=1,
+                               mode=mode.RECVER)
+        member_sender.reset_parameters(generator)
+        member_recver.reset_parameters(generator)
+        sender.load_member_state_dict(index, member_sender.state_dict())
+        recver.load_member_state_dict(index, member_recver.state_dict())
+
+    return sender, recver
+
+
+def test_agents(sender, recver, test_game, evaluator, vocab_size, device):
+    # expected test errors of the sender and recver over the test game
+    ensemble_size = sender.ensemble_size
+    sender.eval()
+    recver.eval()
+    test_errors = 0
+    send_test_entropy = 0
+    with torch.no_grad():
+        for b, batch in enumerate(test_game):
+            send_target, recv_target = batch
+
+            # discrete messages
+            if isinstance(sender, Reinforce):
+                # get recver's action for any given message
+                all_messages = torch.arange(vocab_size).to(device)
+                if ensemble_size is not None:
+                    all_messages = all_messages.expand(ensemble_size, -1)
+                action, recv_logprobs, recv_entropy = recver(all_messages)
+
+                # get sender's distribution of messages for the inputs
+                dist = sender.forward_dist(send_target)
+                probs = dist.probs
+                send_test_entropy += sender._member_mean(dist.entropy())
+
+            # continuous messages
+            else:
+                # the messages come from the same forward pass as the sender's distribution
+                means, stddev, cdf, entropy = sender.forward_dist(send_target)
+                all_messages, probs = evaluator.messages(means, stddev, cdf)
+                action = evaluator.recver_actions(recver, all_messages)
+
+                send_test_entropy += sender._member_mean(entropy)
+
+            # expected errors over every possible message-action
+            test_errors += evaluator(probs, action, send_target, recv_target)
+
+        zero_state = torch.zeros((1, 1), device=device)
+        if ensemble_size is not None:
+            zero_state = zero_state.expand(ensemble_size, -1, -1)
+        message, _, _ = sender(zero_state)
+        action, _, _ = recver(message.detach())
+
+    # a single host sync for all test metrics
+    send_logs = {}
+    recv_logs = {}
+    test_errors = test_errors / test_game.num_batches
+    send_test_entropy = send_test_entropy / test_game.num_batches
+    test_logs = torch.cat([torch.stack([_first(message.float(), ensemble_size),
+                                        _first(action, ensemble_size)]),
+                           test_errors.flatten(0, 1),
+                           send_test_entropy.unsqueeze(0)]).tolist()
+    send_logs['action'], recv_logs['action'] = test_logs[:2]
+    if not message.is_floating_point():
+        # discrete messages are logged as indices
+        send_logs['action'] = _map(int, send_logs['action'])
+    for player, player_logs in enumerate((send_logs, recv_logs)):
+        for metric, metric_name in enumerate(Evaluator.metrics):
+            player_logs[metric_name] = test_logs[2 + player * len(Evaluator.metrics) + metric]
+    send_logs['test_entropy'] = test_logs[-1]
+
+    return send_logs, recv_logs
+
+
+def _log_epoch(writers, epoch, send_logs, recv_logs):
+    for index, writer in enumerate(writers):
+        writer.write(epoch, _member(send_logs, index), _member(recv_logs, index))
+
+
+def _member_dir(rundir, bias, seed):
+    # sweeps format `{bias}` into the directory, e.g. `results/cat-deter-bias{bias}/run`
+    if bias is not None:
+        if '{bias}' not in rundir:
+            raise ValueError(f'directory {rundir} needs a {{bias}} field to sweep over Game.bias')
+        rundir = rundir.format(bias=bias)
+    return f'{rundir}/{seed}'
 
 
 @gin.configurable
@@ -32,195 +151,401 @@ def train(Sender, Recver, vocab_size,
           num_epochs, num_batches, batch_size,
           savedir=None, loaddir=None,
           random_seed=None, Loss=None, device='cpu',
-          last_epochs_metric=10, grounded=None):
-    if random_seed is not None:
-        random.seed(random_seed)
-        torch.manual_seed(random_seed)
-        if device == 'cuda' or (isinstance(device, torch.device) and device.type == 'cuda'):
-            torch.cuda.manual_seed(random_seed)
+          last_epochs_metric=10, grounded=None,
+          ensemble_seeds=None, sweep_biases=None, compile_step=False,
+          time_phases=False, profile_epochs=None, profile_trace=None,
+          epoch_callback=None, checkpoint_every=None, precision='float32',
+          population=None, status_interval=None):
+    # float16 autocast would need a gradient scaler, so only bfloat16 is supported
+    if precision not in ('float32', 'bfloat16'):
+        raise ValueError(f"precision {precision!r} is not supported, use 'float32' or 'bfloat16'")
+
+    # with ensemble_seeds and/or sweep_biases, every (bias, seed) pair trains
+    # together as one batched model and is saved to its own `savedir/seed`
+    # directory, where savedir is formatted with the member's bias for sweeps
+    if sweep_biases is not None:
+        if ensemble_seeds is None:
+            ensemble_seeds = [random_seed if random_seed is not None else 0]
+        member_biases = [bias for bias in sweep_biases for _ in ensemble_seeds]
+        member_seeds = [seed for _ in sweep_biases for seed in ensemble_seeds]
+    elif ensemble_seeds is not None:
+        member_biases = [None for _ in ensemble_seeds]
+        member_seeds = list(ensemble_seeds)
+    else:
+        member_biases = member_seeds = None
+
+    if member_seeds is not None:
+        ensemble_size = len(member_seeds)
+    else:
+        ensemble_size = None
+
+    # under torch.distributed every rank trains on its own batch_size / world_size samples
+    # of the batch and the gradients are averaged, so the result is the same as one big batch
+    rank, world_size = distributed.rank(), distributed.world_size()
+    if world_size > 1:
+        if batch_size % world_size != 0:
+            raise ValueError(f'batch_size {batch_size} is not divisible by the {world_size} ranks')
+        if compile_step:
+            raise ValueError('compile_step does not support data parallel training')
+        batch_size //= world_size
 
     # change device to torch.device
     device = torch.device(device)
 
+    # all the randomness of a run comes from its own generators and never from the global
+    # torch state, so runs in threads of the same process don't change each other's results
+    # a run initializes the agents and then samples from one stream, like
+    # torch.manual_seed(random_seed) did, with its own stream on the device for cuda
+    # every ensemble member has the streams of the single run with its seed
+    if ensemble_size is not None:
+        init_generators = [torch.Generator().manual_seed(seed) for seed in member_seeds]
+        if device.type == 'cpu':
+            generators = init_generators
+        else:
+            generators = [torch.Generator(device=device).manual_seed(seed) for seed in member_seeds]
+        generator = None
+    else:
+        init_generator = torch.Generator()
+        if random_seed is None:
+            init_generator.seed()
+        else:
+            init_generator.manual_seed(random_seed)
+        if device.type == 'cpu':
+            generator = init_generator
+        else:
+            generator = torch.Generator(device=device).manual_seed(init_generator.initial_seed())
+        generators = None
+    run_generators = generators if generators is not None else [generator]
+
+    # a sweep gives every member its own bias, otherwise Game.bias comes from gin
+    game_kwargs = {}
+    if sweep_biases is not None:
+        game_kwargs['bias'] = member_biases
+
     game = Game(num_batches=num_batches,
                 batch_size=batch_size,
-                device=device)
+                device=device,
+                ensemble_size=ensemble_size,
+                generators=generators,
+                generator=generator,
+                **game_kwargs)
     test_game = Game(num_batches=1,
                      batch_size=100,
                      device=device,
-                     training=False)
+                     training=False,
+                     ensemble_size=ensemble_size,
+                     **game_kwargs)
 
     if Loss is None:
         loss_fn = CircleL1(game.num_points)
     else:
         loss_fn = Loss(game.num_points)
 
-    sender = Sender(input_size=1,
-                    output_size=vocab_size,
-                    mode=mode.SENDER).to(device)
-    recver = Recver(input_size=vocab_size,
-                    output_size=1,
-                    mode=mode.RECVER).to(device)
-
-    send_opt = Adam(sender.parameters(), lr=sender.lr)
-    recv_opt = Adam(recver.parameters(), lr=recver.lr)
+    if ensemble_size is None:
+        sender = Sender(input_size=1,
+                        output_size=vocab_size,
+                        mode=mode.SENDER)
+        recver = Recver(input_size=vocab_size,
+                        output_size=1,
+                        mode=mode.RECVER)
+        sender.reset_parameters(init_generator)
+        recver.reset_parameters(init_generator)
+        sender = sender.to(device)
+        recver = recver.to(device)
+        sender.generator = recver.generator = generator
+    else:
+        sender, recver = _build_ensemble(Sender, Recver, vocab_size, init_generators)
+        sender = sender.to(device)
+        recver = recver.to(device)
+        sender.generators = generators
+
+    # sparse embedding gradients only come from looking up the integer messages of a Reinforce
+    # sender, the sender's inputs and the messages of other senders are floats
+    for agent, integer_inputs in ((sender, False), (recver, isinstance(sender, Reinforce))):
+        if not integer_inputs and any(getattr(module, 'sparse', False) for module in agent.modules()):
+            raise ValueError(f'Deterministic.sparse=True needs integer inputs but the {agent.mode.name.lower()} '
+                             f'gets float ones, only use it for the receiver of a Reinforce sender')
+
+    if world_size > 1:
+        distributed.broadcast_parameters(sender)
+        distributed.broadcast_parameters(recver)
+        sender.distributed = recver.distributed = True
+        # the agents are initialized with the seed, every rank then samples its own points
+        for run_generator in run_generators:
+            run_generator.manual_seed(distributed.rank_seed(run_generator.initial_seed(), rank))
+
+    # precision='bfloat16' runs the agents' networks under autocast
+    if precision != 'float32':
+        sender.precision = getattr(torch, precision)
+        recver.precision = getattr(torch, precision)
+
+    # the compiled step also uses fused Adam, the eager step is the fallback
+    send_opt = make_optimizer(sender, fused=compile_step)
+    recv_opt = make_optimizer(recver, fused=compile_step)
+    if compile_step:
+        step_fn = compile_step_losses()
 
     # Saving
-    if savedir is not None:
-        os.makedirs(savedir, exist_ok=True)
-
-        with open(f'{savedir}/config.gin', 'w') as f:
+    if savedir is None:
+        savedirs = []
+    elif ensemble_size is None:
+        savedirs = [savedir]
+    else:
+        savedirs = [_member_dir(savedir, bias, seed)
+                    for bias, seed in zip(member_biases, member_seeds)]
+    # every rank resumes from the checkpoint but only rank 0 writes
+    checkpoint_dir = savedirs[0] if savedirs else None
+    if rank != 0:
+        savedirs = []
+
+    writers = []
+    for index, run_savedir in enumerate(savedirs):
+        os.makedirs(run_savedir, exist_ok=True)
+
+        with open(f'{run_savedir}/config.gin', 'w') as f:
             f.write(gin.operative_config_str())
+            if sweep_biases is not None:
+                f.write(f'\n# Parameters for this sweep member:\nGame.bias = {member_biases[index]}\n')
 
-        logfile = open(f'{savedir}/logs.json', 'w')
-        logfile.write('[ \n')
-    else:
-        logfile = None
+        writers.append(MetricsWriter(run_savedir))
 
     # Loading
     if loaddir is not None:
         loaddir = os.path.join('results', loaddir)
-        if os.path.exists(f'{loaddir}/models.save'):
-            model_save = torch.load(f'{loaddir}/models.save')
-            sender.load_state_dict(model_save['sender'])
-            recver.load_state_dict(model_save['recver'])
-
+        if ensemble_size is None:
+            if os.path.exists(f'{loaddir}/models.save'):
+                model_save = torch.load(f'{loaddir}/models.save')
+                sender.load_state_dict(model_save['sender'])
+                recver.load_state_dict(model_save['recver'])
+        else:
+            for index, (bias, seed) in enumerate(zip(member_biases, member_seeds)):
+                member_loaddir = _member_dir(loaddir, bias, seed)
+                if os.path.exists(f'{member_loaddir}/models.save'):
+                    model_save = torch.load(f'{member_loaddir}/models.save')
+                    sender.load_member_state_dict(index, model_save['sender'])
+                    recver.load_member_state_dict(index, model_save['recver'])
+
+    # population=@PopulationBasedTraining() trains the ensemble members with their own
+    # lrs and ent_regs and replaces the worst members with perturbed copies of the best
+    if population is not None:
+        send_opt, recv_opt = population.setup(sender, recver, send_opt, recv_opt, savedirs, num_epochs)
+
+    # checkpoint_every=N saves the models, optimizers, rng and logs every N epochs
+    # and rerunning the same command resumes from the last checkpoint
+    # an ensemble keeps its checkpoint with its first member
     test_l1_errors = []
-    test_l2_errors = []
-    l1_loss_fn = CircleL1(game.num_points)
-    l2_loss_fn = CircleL2(game.num_points)
-
-    for epoch in range(num_epochs):
-        epoch_send_logs = {}
-        epoch_recv_logs = {}
-
-        # Training
-        sender.train()
-        recver.train()
-        for b, batch in enumerate(game):
-            send_target, recv_target = batch
-
-            message, send_logprobs, send_entropy = sender(send_target)
-            message = message.detach()
-            action, recv_logprobs, recv_entropy = recver(message.detach())
-            send_error = loss_fn(action, send_target).squeeze()
-            recv_error = loss_fn(action, recv_target).squeeze()
-
-            send_loss, send_logs = sender.loss(send_error, send_logprobs, send_entropy)
-            recv_loss, recv_logs = recver.loss(recv_error, recv_logprobs, recv_entropy)
-
-            send_opt.zero_grad()
-            send_loss.backward()
-            send_opt.step()
-
-            recv_opt.zero_grad()
-            recv_loss.backward()
-            recv_opt.step()
-
-            epoch_send_logs = _add_dicts(epoch_send_logs, send_logs)
-            epoch_recv_logs = _add_dicts(epoch_recv_logs, recv_logs)
-
-        epoch_send_logs = _div_dict(epoch_send_logs, game.num_batches)
-        epoch_recv_logs = _div_dict(epoch_recv_logs, game.num_batches)
-
-        # Testing
-        sender.eval()
-        recver.eval()
-        epoch_send_test_error = 0
-        epoch_recv_test_error = 0
-        epoch_send_test_l1_error = 0
-        epoch_recv_test_l1_error = 0
-        epoch_send_test_l2_error = 0
-        epoch_recv_test_l2_error = 0
-        epoch_send_test_entropy = 0
-        with torch.no_grad():
-            for b, batch in enumerate(test_game):
+    epoch_logs = []
+    start_epoch = 0
+    checkpointer = None
+    if checkpoint_every is not None and checkpoint_dir is not None:
+        # a run only resumes from a checkpoint trained with the same config
+        bindings = checkpoint_bindings(gin.operative_config_str())
+        checkpointer = Checkpointer(f'{checkpoint_dir}/checkpoint.save')
+        if checkpointer.exists():
+            checkpoint = checkpointer.load()
+            check_bindings(checkpoint, bindings)
+            sender.load_state_dict(checkpoint['sender'])
+            recver.load_state_dict(checkpoint['recver'])
+            load_buffers_state(sender, checkpoint['sender_buffers'])
+            load_buffers_state(recver, checkpoint['recver_buffers'])
+            send_opt.load_state_dict(checkpoint['send_opt'])
+            recv_opt.load_state_dict(checkpoint['recv_opt'])
+            # data parallel checkpoints keep the random state of every rank
+            if world_size > 1:
+                if len(checkpoint['rng']) != world_size:
+                    raise ValueError(f'checkpoint was saved by {len(checkpoint["rng"])} ranks, not {world_size}')
+                load_rng_state(checkpoint['rng'][rank], run_generators)
+            else:
+                load_rng_state(checkpoint['rng'], run_generators)
+            if population is not None:
+                population.load_state_dict(checkpoint['population'])
+            test_l1_errors = checkpoint['test_l1_errors']
+            epoch_logs = checkpoint['epoch_logs']
+            start_epoch = checkpoint['epoch'] + 1
+            for epoch, (epoch_send_logs, epoch_recv_logs) in enumerate(epoch_logs):
+                _log_epoch(writers, epoch, epoch_send_logs, epoch_recv_logs)
+            print(f'Resuming from epoch {start_epoch}')
+
+    # time_phases writes the wall time of each phase per epoch to timings.jsonl
+    # profile_epochs=(start, end) runs torch.profiler over those epochs, by default the trace is
+    # written next to the logs of the (first) run, with one file per rank for data parallel runs
+    if profile_trace is None:
+        trace_name = 'trace.json' if rank == 0 else f'trace.rank{rank}.json'
+        profile_trace = os.path.join(checkpoint_dir, trace_name) if checkpoint_dir is not None else trace_name
+    timer = PhaseTimer(enabled=time_phases, device=device)
+    step_timer = timer if time_phases else None
+    timing_files = [open(f'{run_savedir}/timings.jsonl', 'w') for run_savedir in savedirs] if time_phases else []
+    profiler = EpochProfiler(profile_epochs, profile_trace, device) if profile_epochs is not None else None
+
+    # status_interval=N rewrites status.json in every run dir every N seconds from a background thread,
+    # `python -m src.status $RESULTS_DIR` shows them and `--serve PORT` serves them for prometheus
+    status = None
+    if status_interval is not None and savedirs:
+        status = LiveStatus(savedirs, num_epochs, num_batches, status_interval, ensemble=ensemble_size is not None)
+        status.start(start_epoch)
+
+    send_metrics = MetricsAccumulator()
+    recv_metrics = MetricsAccumulator()
+    evaluator = make_evaluator(sender, game.num_points, loss_fn)
+
+    stopped = False
+    # status.json says failed if the run raises, so a dead run isn't reported as running
+    state = 'failed'
+    try:
+        for epoch in range(start_epoch, num_epochs):
+            if profiler is not None:
+                profiler.step(epoch)
+            timer.start()
+            send_metrics.reset()
+            recv_metrics.reset()
+
+            # Training
+            sender.train()
+            recver.train()
+            for b, batch in enumerate(game):
                 send_target, recv_target = batch
+                timer.lap('batch')
 
-                # discrete messages
-                if isinstance(sender, Reinforce):
-                    # get recver's action for any given message
-                    all_messages = torch.arange(vocab_size).to(device)
-                    action, recv_logprobs, recv_entropy = recver(all_messages)
-
-                    # get sender's distribution of messages for the inputs
-                    dist = sender.forward_dist(send_target)
-                    probs = dist.probs
-                    epoch_send_test_entropy += dist.entropy().mean().item()
-
-                # continuous messages
+                if compile_step:
+                    send_logs, recv_logs = compiled_step(step_fn, send_opt, recv_opt,
+                                                         sender, recver, loss_fn,
+                                                         send_target, recv_target)
+                    timer.lap('compiled_step')
                 else:
-                    means, stddev, cdf, entropy = sender.forward_dist(send_target)
-                    min_mean = min(means)
-                    max_mean = max(means)
-                    max_std = max(stddev)
-
-                    vocab_size = 1000
-                    all_messages = torch.linspace((min_mean - max_std).item(),
-                                                  (max_mean + max_std).item(), vocab_size).to(device)
-                    probs = cdf(all_messages)
-                    probs[:,1:] -= probs[:,:-1].clone()
-                    action, recv_logprobs, recv_entropy = recver(all_messages.unsqueeze(1))
-
-                    epoch_send_test_entropy += entropy.mean().item()
-
-                # duplicate target for each possible message-action
-                send_targets = send_target.repeat((1, vocab_size))
-                recv_targets = recv_target.repeat((1, vocab_size))
-
-                # get errors for each of those message-actions
-                send_test_error = loss_fn(action, send_targets.T)
-                recv_test_error = loss_fn(action, recv_targets.T)
-                send_test_l1_error = l1_loss_fn(action, send_targets.T)
-                recv_test_l1_error = l1_loss_fn(action, recv_targets.T)
-                send_test_l2_error = l2_loss_fn(action, send_targets.T)
-                recv_test_l2_error = l2_loss_fn(action, recv_targets.T)
-
-                epoch_send_test_error += torch.einsum('bs,sb -> b', probs, send_test_error).mean().item()
-                epoch_recv_test_error += torch.einsum('bs,sb -> b', probs, recv_test_error).mean().item()
-                epoch_send_test_l1_error += torch.einsum('bs,sb -> b', probs, send_test_l1_error).mean().item()
-                epoch_recv_test_l1_error += torch.einsum('bs,sb -> b', probs, recv_test_l1_error).mean().item()
-                epoch_send_test_l2_error += torch.einsum('bs,sb -> b', probs, send_test_l2_error).mean().item()
-                epoch_recv_test_l2_error += torch.einsum('bs,sb -> b', probs, recv_test_l2_error).mean().item()
-
-        message, _, _ = sender(torch.tensor([[0.]]).to(device))
-        action, _, _ = recver(message.detach())
-        epoch_send_logs['action'] = message[0].item()
-        epoch_recv_logs['action'] = action[0].item()
-        epoch_send_logs['test_error'] = epoch_send_test_error / test_game.num_batches
-        epoch_recv_logs['test_error'] = epoch_recv_test_error / test_game.num_batches
-        epoch_send_logs['test_l1_error'] = epoch_send_test_l1_error / test_game.num_batches
-        epoch_recv_logs['test_l1_error'] = epoch_recv_test_l1_error / test_game.num_batches
-        epoch_send_logs['test_l2_error'] = epoch_send_test_l2_error / test_game.num_batches
-        epoch_recv_logs['test_l2_error'] = epoch_recv_test_l2_error / test_game.num_batches
-
-        epoch_send_logs['test_entropy'] = epoch_send_test_entropy / test_game.num_batches
-
-        print(f'EPOCH {epoch}')
-        print(f'ERROR {epoch_send_logs["error"]:2.2f} {epoch_recv_logs["error"]:2.2f}')
-        print(f'LOSS  {epoch_send_logs["loss"]:2.2f} {epoch_recv_logs["loss"]:2.2f}')
-        print(f'TEST  {epoch_send_logs["test_error"]:2.2f} {epoch_recv_logs["test_error"]:2.2f}')
-        print(f'L1    {epoch_send_logs["test_l1_error"]:2.2f} {epoch_recv_logs["test_l1_error"]:2.2f}\n')
-
-        test_l1_errors.append(epoch_send_logs['test_l1_error'] + epoch_recv_logs['test_l1_error'])
-
-        if logfile:
-            if epoch > 0:
-                logfile.write(',\n')
-            dump = {'epoch': epoch,
-                    'sender': epoch_send_logs,
-                    'recver': epoch_recv_logs}
-            json.dump(dump, logfile, indent=2)
-
-    if logfile:
-        logfile.write('\n]')
-        logfile.close()
-        torch.save({'sender': sender.state_dict(),
-                    'recver': recver.state_dict(),
-                    }, f'{savedir}/models.save')
-
-    last_errors_avg = sum(test_l1_errors[-last_epochs_metric:]) / last_epochs_metric
-    print(f'Game Over: {last_errors_avg:2.2f}')
+                    send_loss, recv_loss, send_logs, recv_logs = step_losses(sender, recver, loss_fn,
+                                                                             send_target, recv_target,
+                                                                             timer=step_timer)
+
+                    send_opt.zero_grad()
+                    send_loss.backward()
+                    timer.lap('backward')
+                    if world_size > 1:
+                        distributed.average_gradients(sender)
+                        timer.lap('all_reduce')
+                    send_opt.step()
+                    timer.lap('optimizer')
+
+                    recv_opt.zero_grad()
+                    recv_loss.backward()
+                    timer.lap('backward')
+                    if world_size > 1:
+                        distributed.average_gradients(recver)
+                        timer.lap('all_reduce')
+                    recv_opt.step()
+                    timer.lap('optimizer')
+
+                send_metrics.add(send_logs)
+                recv_metrics.add(recv_logs)
+                if status is not None:
+                    status.step()
+                timer.lap('metrics')
+
+            epoch_send_logs = send_metrics.mean()
+            epoch_recv_logs = recv_metrics.mean()
+            if world_size > 1:
+                epoch_send_logs = distributed.average_logs(epoch_send_logs)
+                epoch_recv_logs = distributed.average_logs(epoch_recv_logs)
+            timer.lap('metrics')
+
+            # Testing
+            send_test_logs, recv_test_logs = test_agents(sender, recver, test_game, evaluator, vocab_size, device)
+            epoch_send_logs.update(send_test_logs)
+            epoch_recv_logs.update(recv_test_logs)
+            timer.lap('test')
+
+            print(f'EPOCH {epoch}')
+            print(f'ERROR {_mean(epoch_send_logs["error"]):2.2f} {_mean(epoch_recv_logs["error"]):2.2f}')
+            print(f'LOSS  {_mean(epoch_send_logs["loss"]):2.2f} {_mean(epoch_recv_logs["loss"]):2.2f}')
+            print(f'TEST  {_mean(epoch_send_logs["test_error"]):2.2f} {_mean(epoch_recv_logs["test_error"]):2.2f}')
+            print(f'L1    {_mean(epoch_send_logs["test_l1_error"]):2.2f} {_mean(epoch_recv_logs["test_l1_error"]):2.2f}\n')
+
+            if ensemble_size is None:
+                test_l1_errors.append(epoch_send_logs['test_l1_error'] + epoch_recv_logs['test_l1_error'])
+            else:
+                test_l1_errors.append([send + recv for send, recv in zip(epoch_send_logs['test_l1_error'],
+                                                                         epoch_recv_logs['test_l1_error'])])
+
+            _log_epoch(writers, epoch, epoch_send_logs, epoch_recv_logs)
+            if status is not None:
+                status.epoch_end(epoch, epoch_send_logs, epoch_recv_logs)
+            timer.lap('logging')
+
+            if population is not None:
+                population.step(epoch, epoch_send_logs, epoch_recv_logs)
+                timer.lap('population')
+
+            if checkpointer is not None:
+                epoch_logs.append((epoch_send_logs, epoch_recv_logs))
+                if (epoch + 1) % checkpoint_every == 0:
+                    rng = rng_state(run_generators)
+                    if world_size > 1:
+                        rng = distributed.all_gather(rng)
+                    if rank == 0:
+                        checkpointer.save({'epoch': epoch,
+                                           'sender': sender.state_dict(),
+                                           'recver': recver.state_dict(),
+                                           'sender_buffers': buffers_state(sender),
+                                           'recver_buffers': buffers_state(recver),
+                                           'send_opt': send_opt.state_dict(),
+                                           'recv_opt': recv_opt.state_dict(),
+                                           'rng': rng,
+                                           'test_l1_errors': test_l1_errors,
+                                           'epoch_logs': epoch_logs,
+                                           'population': population.state_dict() if population is not None else None,
+                                           'config': bindings})
+                    timer.lap('checkpoint')
+
+            if time_phases:
+                timings = timer.pop()
+                print('TIME  ' + ' '.join(f'{phase} {seconds:.3f}s' for phase, seconds in timings.items()) + '\n')
+                for timing_file in timing_files:
+                    timing_file.write(json.dumps({'epoch': epoch, **timings}) + '\n')
+                    timing_file.flush()
+
+            # epoch_callback(epoch, send_logs, recv_logs) returns True to stop training early
+            if epoch_callback is not None and epoch_callback(epoch, epoch_send_logs, epoch_recv_logs):
+                print(f'Stopped early after epoch {epoch}')
+                stopped = True
+                break
+
+        # a failed checkpoint write raises here
+        if checkpointer is not None:
+            checkpointer.wait()
+        state = 'stopped' if stopped else 'finished'
+    finally:
+        if status is not None:
+            status.close(state)
+
+    if profiler is not None:
+        profiler.stop()
+    for timing_file in timing_files:
+        timing_file.close()
+    if population is not None:
+        population.close()
+
+    for index, (run_savedir, writer) in enumerate(zip(savedirs, writers)):
+        writer.close()
+        if ensemble_size is None:
+            models = {'sender': sender.state_dict(),
+                      'recver': recver.state_dict()}
+        else:
+            models = {'sender': sender.member_state_dict(index),
+                      'recver': recver.member_state_dict(index)}
+        torch.save(models, f'{run_savedir}/models.save')
+
+    # the mean over the epochs that ran of the last last_epochs_metric, so runs stopped early
+    # or shorter than last_epochs_metric aren't divided by epochs they never had, nan without epochs
+    last_errors = test_l1_errors[-last_epochs_metric:]
+    if ensemble_size is None:
+        last_errors_avg = sum(last_errors) / len(last_errors) if last_errors else float('nan')
+        print(f'Game Over: {last_errors_avg:2.2f}')
+    else:
+        if last_errors:
+            last_errors_avg = [sum(errors) / len(last_errors)
+                               for errors in zip(*last_errors)]
+        else:
+            last_errors_avg = [float('nan')] * ensemble_size
+        print(f'Game Over: {" ".join(f"{error:2.2f}" for error in last_errors_avg)}')
 
     return last_errors_avg
 
@@ -0,0 +1,156 @@
+#!/usr/bin/env python
+import argparse
+import ast
+from concurrent.futures import ProcessPoolExecutor
+import hashlib
+import json
+import math
+import multiprocessing
+import os
+import random
+import re
+
+import gin
+import torch
+
+from orion_runs import add_trial_args, run_trial
+
+
+# `Reinforce.lr = reinforce-lr~loguniform(1e-4, 1e-2)` in the -search.gin configs
+PRIOR = re.compile(r'^(?P<binding>[^#=]+=\s*)(?P<name>[\w-]+)~(?P<prior>\w+)\((?P<args>.*)\)\s*$')
+
+
+def parse_search_space(config_file):
+    # the lines of a -search.gin config and the orion priors in them by name
+    with open(config_file) as f:
+        lines = f.read().splitlines()
+
+    priors = {}
+    for line in lines:
+        match = PRIOR.match(line)
+        if match:
+            call = ast.parse(f'f({match["args"]})', mode='eval').body
+            args = [ast.literal_eval(arg) for arg in call.args]
+            kwargs = {keyword.arg: ast.literal_eval(keyword.value) for keyword in call.keywords}
+            priors[match['name']] = (match['prior'], args, kwargs)
+
+    return lines, priors
+
+
+def sample_params(priors, rng):
+    # same distributions as orion's priors
+    params = {}
+    for name, (prior, args, kwargs) in priors.items():
+        if prior == 'loguniform':
+            low, high = args
+            value = math.exp(rng.uniform(math.log(low), math.log(high)))
+            params[name] = round(value) if kwargs.get('discrete') else value
+        elif prior == 'uniform':
+            low, high = args
+            params[name] = rng.randint(low, high) if kwargs.get('discrete') else rng.uniform(low, high)
+        elif prior == 'choices':
+            options = args[0] if len(args) == 1 and isinstance(args[0], (list, tuple)) else args
+            params[name] = rng.choice(list(options))
+        else:
+            raise ValueError(f'prior {prior} of {name} is not supported')
+    return params
+
+
+def trial_config(lines, params):
+    # the search config with every prior replaced by the trial's value
+    config = []
+    for line in lines:
+        match = PRIOR.match(line)
+        if match:
+            line = f'{match["binding"]}{params[match["name"]]!r}'
+        config.append(line)
+    return '\n'.join(config)
+
+
+def trial_id(params):
+    return hashlib.md5(json.dumps(params, sort_keys=True).encode()).hexdigest()
+
+
+def _init_worker(num_threads):
+    torch.set_num_threads(num_threads)
+
+
+def _run_trial(args, config, savedir):
+    # every trial starts from an empty gin config so no binding leaks between trials
+    gin.clear_config()
+    gin.parse_config_files_and_bindings(None, [config] + (args.gin_param or []))
+    return run_trial(args, savedir)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='run the trials of a -search.gin config in one process, '
+                                                 'with the same directory layout as orion')
+    parser.add_argument('--config', '--gin_file', required=True, help='a -search.gin config')
+    parser.add_argument('--gin_param', '-p', nargs='+')
+    parser.add_argument('--name', '-n', required=True, help='experiment name, like orion hunt -n')
+    parser.add_argument('--working-dir', required=True,
+                        help='trials are saved in {working_dir}/{name}_{id}, like orion hunt --working-dir')
+    parser.add_argument('--max-trials', type=int, default=100)
+    parser.add_argument('--trials', default=None,
+                        help='json lines of parameter assignments to run instead of sampling them')
+    parser.add_argument('--seed', type=int, default=None, help='seed for sampling parameters')
+    parser.add_argument('--concurrent_trials', type=int, default=1,
+                        help='run trials in parallel processes')
+    parser.add_argument('--threads_per_trial', type=int, default=1,
+                        help='torch intra-op threads for each parallel trial')
+    add_trial_args(parser)
+    args = parser.parse_args()
+
+    lines, priors = parse_search_space(args.config)
+    os.makedirs(args.working_dir, exist_ok=True)
+    results_file = os.path.join(args.working_dir, 'trials.jsonl')
+
+    # trials already in trials.jsonl are skipped so a search can be continued
+    done = set()
+    if os.path.exists(results_file):
+        with open(results_file) as f:
+            done = {json.loads(line)['id'] for line in f if line.strip()}
+
+    if args.trials is not None:
+        with open(args.trials) as f:
+            all_params = [json.loads(line) for line in f if line.strip()]
+    else:
+        rng = random.Random(args.seed)
+        all_params = [sample_params(priors, rng) for _ in range(args.max_trials)]
+
+    trials = []
+    for params in all_params:
+        missing = set(priors) - set(params)
+        if missing:
+            raise ValueError(f'trial {params} has no value for {", ".join(sorted(missing))}')
+        id_ = trial_id(params)
+        if id_ not in done:
+            done.add(id_)
+            trials.append((id_, params, os.path.join(args.working_dir, f'{args.name}_{id_}')))
+    print(f'running {len(trials)} trials')
+
+    configs = [trial_config(lines, params) for _, params, _ in trials]
+    savedirs = [savedir for _, _, savedir in trials]
+    if args.concurrent_trials > 1:
+        executor = ProcessPoolExecutor(max_workers=args.concurrent_trials,
+                                       mp_context=multiprocessing.get_context('spawn'),
+                                       initializer=_init_worker,
+                                       initargs=(args.threads_per_trial,))
+        objectives = executor.map(_run_trial, [args] * len(trials), configs, savedirs)
+    else:
+        executor = None
+        objectives = map(_run_trial, [args] * len(trials), configs, savedirs)
+
+    best = None
+    with open(results_file, 'a') as f:
+        for (id_, params, savedir), objective in zip(trials, objectives):
+            f.write(json.dumps({'id': id_, 'params': params, 'objective': objective}) + '\n')
+            f.flush()
+            if best is None or objective < best[0]:
+                best = (objective, id_, params)
+
+    if executor is not None:
+        executor.shutdown()
+
+    if best is not None:
+        print(f'best trial {best[1]}: {best[0]:2.2f} {best[2]}')